@@ -31,6 +31,7 @@ function PatientDetail({ patient, onBack }) {
   ]);
   const [input, setInput] = useState('');
   const chatEndRef = useRef(null);
+  const chatAbortRef = useRef(null);
 
   useEffect(() => {
     const fetchUserData = async () => {
@@ -83,6 +84,11 @@ function PatientDetail({ patient, onBack }) {
     window.scrollTo(0, 0);
   }, []);
 
+  // Leaving the patient stops a reply that is still streaming, the backend cancels the upstream request
+  useEffect(() => {
+    return () => chatAbortRef.current?.abort();
+  }, []);
+
   // Auto-scroll to the latest chat message
   useEffect(() => {
     if (chatEndRef.current) {
@@ -99,23 +105,61 @@ function PatientDetail({ patient, onBack }) {
     setMessages(newMessages);
     setInput('');
 
+    // Reply is streamed as Server-Sent Events and rendered token by token,
+    // a reply still streaming for the previous question is stopped first
+    chatAbortRef.current?.abort();
+    const controller = new AbortController();
+    chatAbortRef.current = controller;
+    setMessages(msgs => [...msgs, { role: 'assistant', content: '' }]);
+    const appendToReply = (text) => setMessages(msgs => {
+      const last = msgs[msgs.length - 1];
+      return [...msgs.slice(0, -1), { ...last, content: last.content + text }];
+    });
+
     try {
-      const res = await fetch('http://localhost:8080/api/doctor-chat', {
+      const res = await fetch('http://localhost:8080/api/doctor-chat/stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           user_id: patient.id,
           messages: newMessages
-        })
+        }),
+        signal: controller.signal
       });
-      const data = await res.json();
-      if (data.response) {
-        setMessages(msgs => [...msgs, { role: 'assistant', content: data.response }]);
-      } else if (data.error) {
-        setMessages(msgs => [...msgs, { role: 'assistant', content: 'Error: ' + data.error }]);
+      if (!res.ok) {
+        const data = await res.json();
+        throw new Error(data.error || 'Request failed');
+      }
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+          const type = event.match(/^event: (.*)$/m)?.[1] || 'message';
+          const payload = JSON.parse(event.match(/^data: (.*)$/m)?.[1] || '{}');
+          if (type === 'error') {
+            appendToReply('Error: ' + payload.error);
+          } else if (payload.delta) {
+            appendToReply(payload.delta);
+          }
+        }
       }
     } catch (err) {
-      setMessages(msgs => [...msgs, { role: 'assistant', content: 'Error: ' + err.message }]);
+      if (err.name !== 'AbortError') {
+        appendToReply('Error: ' + err.message);
+      }
+    } finally {
+      if (chatAbortRef.current === controller) {
+        chatAbortRef.current = null;
+      }
     }
   }
 
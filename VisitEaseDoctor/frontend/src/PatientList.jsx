@@ -33,106 +33,44 @@ function PatientList() {
   useEffect(() => {
     const fetchPatients = async () => {
       console.log('Starting to fetch patients...');
-      const startTime = Date.now();
-      const failedUsers = [];
 
       try {
-        // Fetch user IDs
-        console.log('Fetching user IDs from /get-user-ids...');
-        const response = await fetch('http://localhost:8080/get-user-ids');
-        if (!response.ok) {
-          const errorText = await response.text();
-          console.error('Failed to fetch user IDs:', {
-            status: response.status,
-            statusText: response.statusText,
-            error: errorText
-          });
-          throw new Error(`Failed to fetch patients: ${response.status} ${response.statusText}`);
-        }
-        
-        const userIds = await response.json();
-        console.log('Received user IDs:', userIds);
-        
-        // Fetch structured data for each user
-        console.log('Starting to fetch structured data for each user...');
-        const patientPromises = userIds.map(async (userId) => {
-          try {
-            // Try to fetch structured data first
-            const dataResponse = await fetch(`http://localhost:8080/get-structured-data?user_id=${userId}`);
-            let userData = null;
-            let insuranceCard = {};
-            let doctorLetter = {};
-            let name = '';
-            let age = 'N/A';
-            let gender = 'N/A';
-            let lastVisit = 'N/A';
-            let appointmentTime = 'N/A';
-            let incomplete = false;
-            let email = '';
-            let createdAt = '';
-
-            if (dataResponse.ok) {
-              userData = await dataResponse.json();
-              insuranceCard = userData.insuranceCard || {};
-              doctorLetter = userData.doctorLetter || {};
-              if (insuranceCard.name && insuranceCard.name.trim() !== '') {
-                name = insuranceCard.name;
-              }
-              age = calculateAge(insuranceCard.birthDate) || 'N/A';
-              gender = insuranceCard.gender || 'N/A';
-              lastVisit = formatDate(doctorLetter.created_at) || 'N/A';
-            }
-
-            // If no insurance name, fetch registration info
-            if (!name || name.trim() === '') {
-              const profileResponse = await fetch(`http://localhost:8080/get-user-basic-profile?user_id=${userId}`);
-              if (profileResponse.ok) {
-                const profile = await profileResponse.json();
-                if (profile.full_name && profile.full_name.trim() !== '') {
-                  name = profile.full_name;
-                  age = calculateAge(profile.date_of_birth) || 'N/A';
-                  email = profile.email || '';
-                  createdAt = profile.created_at || '';
-                  incomplete = true;
-                }
-              }
-            }
-
-            // If still no name, fallback
-            if (!name || name.trim() === '') name = 'Unknown Patient';
+        // Fetch the roster page by page, each page is a single request
+        const patientsData = [];
+        let cursor = null;
+        do {
+          const query = cursor ? `?start_after=${encodeURIComponent(cursor)}` : '';
+          console.log(`Fetching roster page from /get-patient-roster${query}...`);
+          const response = await fetch(`http://localhost:8080/get-patient-roster${query}`);
+          if (!response.ok) {
+            const errorText = await response.text();
+            console.error('Failed to fetch patient roster:', {
+              status: response.status,
+              statusText: response.statusText,
+              error: errorText
+            });
+            throw new Error(`Failed to fetch patients: ${response.status} ${response.statusText}`);
+          }
 
-            return {
-              id: userId,
-              name,
-              age,
-              gender,
-              lastVisit,
-              appointmentTime,
-              email,
-              createdAt,
-              data: userData,
-              incomplete
-            };
-          } catch (err) {
-            // If both fetches fail, return a placeholder patient
-            console.error(`Error processing user ${userId}:`, err);
-            failedUsers.push({ id: userId, error: err.message });
-            return {
-              id: userId,
-              name: 'Unknown Patient',
-              age: 'N/A',
-              gender: 'N/A',
-              lastVisit: 'N/A',
+          const page = await response.json();
+          for (const summary of page.patients) {
+            patientsData.push({
+              id: summary.user_id,
+              name: summary.full_name || 'Unknown Patient',
+              age: calculateAge(summary.date_of_birth) || 'N/A',
+              gender: summary.gender || 'N/A',
+              lastVisit: summary.last_updated.doctorLetter || 'N/A',
               appointmentTime: 'N/A',
-              email: '',
-              createdAt: '',
+              insuranceProvider: summary.insurance_provider,
+              email: summary.email,
+              createdAt: summary.created_at,
               data: null,
-              incomplete: true
-            };
+              incomplete: summary.incomplete
+            });
           }
-        });
+          cursor = page.next_cursor;
+        } while (cursor);
 
-        const patientsData = (await Promise.all(patientPromises)).filter(Boolean);
         console.log('Final processed patients data:', patientsData);
         
         setPatients(patientsData);
@@ -168,22 +106,6 @@ function PatientList() {
     }
   };
 
-  const formatDate = (dateString) => {
-    if (!dateString) {
-      console.log('No date string provided for formatting');
-      return null;
-    }
-    try {
-      const date = new Date(dateString);
-      const formatted = date.toLocaleDateString('de-DE');
-      console.log(`Formatted date ${dateString} to ${formatted}`);
-      return formatted;
-    } catch (err) {
-      console.error('Error formatting date:', err);
-      return null;
-    }
-  };
-
   const filteredPatients = patients.filter(patient =>
     patient.name.toLowerCase().includes(searchTerm.toLowerCase())
   );
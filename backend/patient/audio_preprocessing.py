@@ -0,0 +1,187 @@
+import io
+import os
+import wave
+import struct
+import numpy as np
+from threading import Lock
+
+# Whisper works on 16 kHz mono internally, anything more is upload size without benefit
+TARGET_RATE = 16000
+FRAME_MS = 30
+
+SILENCE_RMS = int(os.getenv('SILENCE_RMS', 500)) / 32768
+# Kept around the speech when trimming, so the first and last syllables are not clipped
+TRIM_PADDING_MS = int(os.getenv('TRIM_PADDING_MS', 200))
+# Recordings longer than this are split at the quietest point between the two lengths
+SPLIT_MIN_SECONDS = int(os.getenv('TRANSCRIPTION_SPLIT_MIN_SECONDS', 20))
+SPLIT_MAX_SECONDS = int(os.getenv('TRANSCRIPTION_SPLIT_MAX_SECONDS', 40))
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def decode_wav(data: bytes):
+    """Returns (samples, rate) with float32 samples in [-1, 1] shaped
+    (frames, channels), or None when data is not a WAV file this can read.
+    Covers the integer PCM and float formats browsers record, the stdlib
+    wave module only reads integer PCM."""
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack('<4sI', data[offset:offset + 8])
+        body = data[offset + 8:offset + 8 + size]
+        if chunk_id == b'fmt ' and len(body) >= 16:
+            fmt = struct.unpack('<HHIIHH', body[:16])
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # The real format is the first two bytes of the sub format GUID
+                fmt = (struct.unpack('<H', body[24:26])[0],) + fmt[1:]
+        elif chunk_id == b'data' and fmt:
+            format_tag, channels, rate, _, _, bits = fmt
+            # Recorders streaming to disk leave the size at 0 or 0xFFFFFFFF
+            body = data[offset + 8:] if size in (0, 0xFFFFFFFF) else body
+            samples = _decode_samples(body, format_tag, bits)
+            if samples is None or not channels:
+                return None
+            samples = samples[:len(samples) - len(samples) % channels]
+            return samples.reshape(-1, channels), rate
+        offset += 8 + size + size % 2
+    return None
+
+
+def _decode_samples(body: bytes, format_tag: int, bits: int):
+    width = bits // 8
+    body = body[:len(body) - len(body) % width] if width else b''
+    if format_tag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        return np.frombuffer(body, dtype=f'<f{width}').astype(np.float32)
+    if format_tag != WAVE_FORMAT_PCM:
+        return None
+    if bits == 8:
+        return (np.frombuffer(body, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if bits in (16, 32):
+        return np.frombuffer(body, dtype=f'<i{width}').astype(np.float32) / 2 ** (bits - 1)
+    if bits == 24:
+        raw = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        return (np.where(values >= 2 ** 23, values - 2 ** 24, values) / 2 ** 23).astype(np.float32)
+    return None
+
+
+def to_mono(samples: np.ndarray):
+    return samples.mean(axis=1) if samples.ndim == 2 else samples
+
+
+def resample(samples: np.ndarray, rate: int, target_rate: int = TARGET_RATE):
+    if rate == target_rate or not len(samples):
+        return samples
+    ratio = rate / target_rate
+    if ratio > 1:
+        # Averaging over one output period keeps frequencies above the new Nyquist from folding back
+        width = int(np.ceil(ratio))
+        samples = np.convolve(samples, np.full(width, 1 / width, dtype=np.float32), mode='same')
+    positions = np.arange(int(len(samples) / ratio)) * ratio
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def frame_rms(samples: np.ndarray, rate: int = TARGET_RATE):
+    # RMS energy of every complete FRAME_MS frame
+    frame = rate * FRAME_MS // 1000
+    frames = samples[:len(samples) - len(samples) % frame].reshape(-1, frame)
+    return np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+
+
+def trim_silence(samples: np.ndarray, rate: int = TARGET_RATE):
+    voiced = np.flatnonzero(frame_rms(samples, rate) >= SILENCE_RMS)
+    if not len(voiced):
+        return samples[:0]
+    frame = rate * FRAME_MS // 1000
+    padding = rate * TRIM_PADDING_MS // 1000
+    start = max(0, voiced[0] * frame - padding)
+    end = min(len(samples), (voiced[-1] + 1) * frame + padding)
+    return samples[start:end]
+
+
+def split_at_silences(samples: np.ndarray, rate: int = TARGET_RATE):
+    """Cuts a long recording into parts between SPLIT_MIN_SECONDS and
+    SPLIT_MAX_SECONDS, each cut at the quietest frame in that range, so no
+    word is split between two transcriptions."""
+    frame = rate * FRAME_MS // 1000
+    rms = frame_rms(samples, rate)
+    min_frames = SPLIT_MIN_SECONDS * 1000 // FRAME_MS
+    max_frames = SPLIT_MAX_SECONDS * 1000 // FRAME_MS
+
+    parts = []
+    start = 0
+    while len(rms) - start > max_frames:
+        cut = start + min_frames + int(np.argmin(rms[start + min_frames:start + max_frames]))
+        parts.append(samples[start * frame:cut * frame])
+        start = cut
+    parts.append(samples[start * frame:])
+    return parts
+
+
+def encode_wav(samples: np.ndarray, rate: int = TARGET_RATE):
+    pcm = (np.clip(samples, -1, 1) * 32767).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def prepare_for_transcription(data: bytes):
+    """Returns the WAV files to transcribe, in order: trimmed, 16 kHz mono
+    16-bit and split at silences when long. Returns an empty list when there
+    is no speech at all, and None for compressed recordings (webm, m4a),
+    which are already small and are sent unchanged."""
+    decoded = decode_wav(data)
+    if decoded is None:
+        return None
+    samples, rate = decoded
+    samples = trim_silence(resample(to_mono(samples), rate))
+    if not len(samples):
+        return []
+    return [encode_wav(part) for part in split_at_silences(samples)]
+
+
+class TranscriptionStats:
+    """Upload size and latency of Whisper transcriptions, separately for
+    preprocessed recordings and the ones sent as recorded, to compare the two."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.paths = {
+            path: {'transcriptions': 0, 'parts': 0, 'received_bytes': 0, 'uploaded_bytes': 0, 'seconds': 0.0}
+            for path in ('preprocessed', 'unchanged')
+        }
+
+    def record(self, preprocessed: bool, received_bytes: int, uploaded_bytes: int, parts: int, seconds: float):
+        with self._lock:
+            totals = self.paths['preprocessed' if preprocessed else 'unchanged']
+            totals['transcriptions'] += 1
+            totals['parts'] += parts
+            totals['received_bytes'] += received_bytes
+            totals['uploaded_bytes'] += uploaded_bytes
+            totals['seconds'] += seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                path: {
+                    'transcriptions': totals['transcriptions'],
+                    'parts': totals['parts'],
+                    'received_bytes': totals['received_bytes'],
+                    'uploaded_bytes': totals['uploaded_bytes'],
+                    'upload_ratio': totals['uploaded_bytes'] / totals['received_bytes'] if totals['received_bytes'] else 0.0,
+                    'avg_seconds': totals['seconds'] / totals['transcriptions'] if totals['transcriptions'] else 0.0
+                }
+                for path, totals in self.paths.items()
+            }
+
+
+transcription_stats = TranscriptionStats()
@@ -0,0 +1,160 @@
+import io
+import os
+import time
+import uuid
+import wave
+import numpy as np
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from audio_preprocessing import SILENCE_RMS, FRAME_MS, frame_rms
+
+# Chunks are raw 16-bit little-endian mono PCM at this rate
+SAMPLE_RATE = 16000
+FRAME_BYTES = SAMPLE_RATE * FRAME_MS // 1000 * 2
+
+# A pause this long ends a segment, but only once the segment has this much audio
+SEGMENT_SILENCE_MS = int(os.getenv('SEGMENT_SILENCE_MS', 600))
+MIN_SEGMENT_MS = int(os.getenv('MIN_SEGMENT_MS', 2000))
+MAX_SESSION_SECONDS = int(os.getenv('MAX_AUDIO_SESSION_SECONDS', 300))
+AUDIO_SESSION_TTL = int(os.getenv('AUDIO_SESSION_TTL', 120))
+# Every session can buffer MAX_SESSION_SECONDS of audio (about 9.6 MB at the defaults)
+MAX_SESSIONS_PER_USER = int(os.getenv('MAX_AUDIO_SESSIONS_PER_USER', 2))
+MAX_SESSIONS = int(os.getenv('MAX_AUDIO_SESSIONS', 64))
+SEGMENT_TRANSCRIPTION_WORKERS = int(os.getenv('SEGMENT_TRANSCRIPTION_WORKERS', 4))
+
+_segment_executor = ThreadPoolExecutor(max_workers=SEGMENT_TRANSCRIPTION_WORKERS, thread_name_prefix='segments')
+
+
+def frame_voiced(pcm: bytes):
+    # One flag per complete frame: is its RMS energy above the silence threshold
+    samples = np.frombuffer(pcm[:len(pcm) - len(pcm) % 2], dtype='<i2').astype(np.float32) / 32768
+    return (frame_rms(samples, SAMPLE_RATE) >= SILENCE_RMS).tolist()
+
+
+def to_wav(pcm: bytes):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class AudioSession:
+    """Audio of one recording that arrives in chunks. Whenever the buffered
+    audio contains a long enough pause, everything before the middle of the
+    pause is cut off as a segment and transcribed in the background."""
+
+    def __init__(self, user_id, transcribe):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.transcribe = transcribe
+        self.next_seq = 0
+        self.total_bytes = 0
+        self.touched_at = time.monotonic()
+        self._buffer = bytearray()
+        self._voiced = []
+        self._segments = []
+        self._lock = Lock()
+
+    def _submit(self, pcm: bytes, voiced):
+        # Pure silence is never sent to Whisper, it tends to make up words for it
+        if any(voiced):
+            self._segments.append(_segment_executor.submit(self.transcribe, to_wav(pcm), 'segment.wav'))
+
+    def _cut_segments(self):
+        silence_frames = SEGMENT_SILENCE_MS // FRAME_MS
+        min_frames = MIN_SEGMENT_MS // FRAME_MS
+        run = 0
+        for index, voiced in enumerate(self._voiced):
+            run = 0 if voiced else run + 1
+            if run == silence_frames and index + 1 - run >= min_frames:
+                cut = index + 1 - run // 2
+                self._submit(bytes(self._buffer[:cut * FRAME_BYTES]), self._voiced[:cut])
+                del self._buffer[:cut * FRAME_BYTES]
+                del self._voiced[:cut]
+                return self._cut_segments()
+
+    def append(self, seq: int, pcm: bytes):
+        with self._lock:
+            if seq != self.next_seq:
+                raise ValueError(f'Expected chunk {self.next_seq}, got {seq}')
+            if self.total_bytes + len(pcm) > MAX_SESSION_SECONDS * SAMPLE_RATE * 2:
+                raise OverflowError('Recording is too long')
+
+            self.next_seq += 1
+            self.total_bytes += len(pcm)
+            self.touched_at = time.monotonic()
+
+            complete = len(self._voiced) * FRAME_BYTES
+            self._buffer.extend(pcm)
+            self._voiced.extend(frame_voiced(bytes(self._buffer[complete:])))
+            self._cut_segments()
+            return len(self._segments)
+
+    def finish(self):
+        """Transcribes the rest of the audio and returns the whole transcript,
+        waiting only for the segments that are not done yet."""
+        with self._lock:
+            self._submit(bytes(self._buffer), frame_voiced(bytes(self._buffer)) or [False])
+            self._buffer.clear()
+            self._voiced.clear()
+            segments = list(self._segments)
+        return ' '.join(text.strip() for text in (segment.result() for segment in segments) if text.strip())
+
+    def cancel(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.cancel()
+
+
+class AudioSessionStore:
+    """Open audio sessions. A user opening more than max_per_user replaces
+    their oldest one, past max_sessions in total new sessions are refused."""
+
+    def __init__(self, ttl: float, max_per_user: int, max_sessions: int):
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self.max_sessions = max_sessions
+        self._sessions = {}
+        self._lock = Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id, audio_session in list(self._sessions.items()):
+            if now - audio_session.touched_at > self.ttl:
+                audio_session.cancel()
+                del self._sessions[session_id]
+
+    def create(self, user_id, transcribe):
+        """Returns the new session, or None when the server has no room for one."""
+        with self._lock:
+            self._expire()
+            # Insertion order, so the first ones are the oldest
+            own = [audio_session for audio_session in self._sessions.values() if audio_session.user_id == user_id]
+            for audio_session in own[:max(0, len(own) - self.max_per_user + 1)]:
+                audio_session.cancel()
+                del self._sessions[audio_session.id]
+            if len(self._sessions) >= self.max_sessions:
+                return None
+
+            audio_session = AudioSession(user_id, transcribe)
+            self._sessions[audio_session.id] = audio_session
+        return audio_session
+
+    def get(self, session_id, user_id):
+        with self._lock:
+            self._expire()
+            audio_session = self._sessions.get(session_id)
+        return audio_session if audio_session and audio_session.user_id == user_id else None
+
+    def pop(self, session_id, user_id):
+        with self._lock:
+            audio_session = self._sessions.get(session_id)
+            if audio_session and audio_session.user_id == user_id:
+                return self._sessions.pop(session_id)
+        return None
+
+
+audio_sessions = AudioSessionStore(AUDIO_SESSION_TTL, MAX_SESSIONS_PER_USER, MAX_SESSIONS)
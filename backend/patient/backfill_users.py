@@ -0,0 +1,44 @@
+# One-off backfill for user documents created before the roster summary and
+# updated_at existed:
+# - the roster summary is built from the latest document of every type, so
+#   roster pages never have to query subcollections, summaries from before
+#   the insurance gender was kept are built again
+# - updated_at is set to the current time, otherwise those users never match
+#   /get-user-ids?updated_since=... and every doctor client now picks them up
+#   in its next incremental sync
+# Run from backend/patient: python backfill_users.py [--dry-run]
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from firebase_admin import firestore
+from firebase_config import db
+from patient_data import build_roster_summary
+
+BACKFILL_WORKERS = 8
+
+
+def backfill_user(doc, dry_run):
+    user_dict = doc.to_dict() or {}
+    missing = [field for field in ('roster', 'updated_at') if field not in user_dict]
+    roster = user_dict.get('roster') or {}
+    if 'insurance_name' in roster and 'insurance_gender' not in roster:
+        missing.append('roster')
+    if dry_run or not missing:
+        return missing
+    if 'roster' in missing:
+        build_roster_summary(doc.id)
+    if 'updated_at' in missing:
+        doc.reference.set({'updated_at': firestore.SERVER_TIMESTAMP}, merge=True)
+    return missing
+
+
+if __name__ == "__main__":
+    dry_run = '--dry-run' in sys.argv
+    docs = list(db.collection('users').select(['roster', 'updated_at']).stream())
+
+    # Users are backfilled concurrently, each one's four subcollection queries run in turn
+    with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as executor:
+        results = list(executor.map(lambda doc: backfill_user(doc, dry_run), docs))
+
+    action = 'Would backfill' if dry_run else 'Backfilled'
+    print(f"{action} the roster summary of {sum('roster' in missing for missing in results)} "
+          f"and updated_at of {sum('updated_at' in missing for missing in results)} of {len(docs)} users")
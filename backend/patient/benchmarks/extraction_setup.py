@@ -0,0 +1,39 @@
+# Per-call setup cost of a Gemini extraction before the request is sent:
+# the old path (load_dotenv, genai.configure, a new GenerativeModel and a
+# freshly rendered prompt on every call) against the shared ExtractionEngine.
+# No request is made, so any GOOGLE_API_KEY value works.
+# Run from backend/patient: python -m benchmarks.extraction_setup
+import os
+import time
+import google.generativeai as genai
+from dotenv import load_dotenv
+from image_data.gemini_api import SCHEMAS, render_prompt, extraction_engine
+
+CALLS = 200
+
+
+def per_call_setup(document_type):
+    load_dotenv()
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    model = genai.GenerativeModel('gemini-1.5-flash')
+    return model, render_prompt(SCHEMAS[document_type])
+
+
+def engine_setup(document_type):
+    return extraction_engine.model, extraction_engine.prompt(document_type)
+
+
+def microseconds_per_call(setup):
+    start_time = time.perf_counter()
+    for i in range(CALLS):
+        setup(list(SCHEMAS)[i % len(SCHEMAS)])
+    return (time.perf_counter() - start_time) / CALLS * 1e6
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    engine_setup('labData')
+
+    before = microseconds_per_call(per_call_setup)
+    after = microseconds_per_call(engine_setup)
+    print(f"per-call setup: {before:.0f} us -> {after:.1f} us")
@@ -0,0 +1,146 @@
+# Local stand-in for the parts of the Gemini API the extraction uses: the
+# Files API upload and generateContent. Answers follow the response schema
+# of the request, filled with placeholder values, and /stats shows how many
+# PDF bytes arrived inline versus as file references.
+# Run from backend/patient: python -m benchmarks.gemini_stub_server --port 8089
+# then start the backend with GEMINI_API_ENDPOINT=http://127.0.0.1:8089
+import re
+import json
+import time
+import uuid
+import base64
+import argparse
+import datetime
+from email.parser import BytesParser
+from email.policy import HTTP
+from threading import Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILE_TTL = 48 * 3600
+
+files = {}
+counters = {'uploads': 0, 'uploaded_bytes': 0, 'generate_calls': 0, 'inline_bytes': 0, 'file_references': 0}
+lock = Lock()
+
+
+# The SDK's REST transport sends schema types as enum numbers
+SCHEMA_TYPES = {1: 'STRING', 2: 'NUMBER', 3: 'INTEGER', 4: 'BOOLEAN', 5: 'ARRAY', 6: 'OBJECT'}
+
+
+def placeholder(schema):
+    schema_type = schema.get('type', 'OBJECT')
+    schema_type = SCHEMA_TYPES.get(schema_type, str(schema_type).upper())
+    if schema_type == 'OBJECT':
+        return {name: placeholder(item) for name, item in schema.get('properties', {}).items()}
+    if schema_type == 'ARRAY':
+        return [placeholder(schema.get('items', {}))]
+    if schema_type in ('NUMBER', 'INTEGER'):
+        return 0
+    if schema_type == 'BOOLEAN':
+        return False
+    return 'stub'
+
+
+def file_resource(file_id, display_name, mime_type, size):
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=FILE_TTL)
+    return {
+        'name': f'files/{file_id}',
+        'displayName': display_name,
+        'mimeType': mime_type,
+        'sizeBytes': str(size),
+        'uri': f'stub://files/{file_id}',
+        'state': 'ACTIVE',
+        'expirationTime': expiration.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            with lock:
+                return self._send(200, dict(counters, files=len(files)))
+        match = re.match(r'^/v1beta/(files/[^?]+)', self.path)
+        if match and match.group(1) in files:
+            return self._send(200, files[match.group(1)]['resource'])
+        self._send(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        if self.path.startswith('/upload/v1beta/files'):
+            return self._upload()
+        if re.match(r'^/v1beta/models/[^:]+:generateContent', self.path):
+            return self._generate()
+        self._send(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def _upload(self):
+        header = f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8')
+        message = BytesParser(policy=HTTP).parsebytes(header + self._body())
+        metadata, data, mime_type = {}, b'', 'application/octet-stream'
+        for part in message.iter_parts():
+            if part.get_param('name', header='content-disposition') == 'metadata':
+                metadata = json.loads(part.get_payload(decode=True))
+            else:
+                data = part.get_payload(decode=True)
+                mime_type = part.get_content_type()
+
+        file_id = uuid.uuid4().hex[:12]
+        display_name = metadata.get('file', {}).get('displayName', file_id)
+        resource = file_resource(file_id, display_name, mime_type, len(data))
+        with lock:
+            files[resource['name']] = {'resource': resource, 'size': len(data)}
+            counters['uploads'] += 1
+            counters['uploaded_bytes'] += len(data)
+        self._send(200, {'file': resource})
+
+    def _generate(self):
+        request = json.loads(self._body() or b'{}')
+        inline_bytes = 0
+        references = 0
+        for content in request.get('contents', []):
+            for part in content.get('parts', []):
+                if 'inlineData' in part:
+                    inline_bytes += len(base64.b64decode(part['inlineData'].get('data', '')))
+                if 'fileData' in part:
+                    uri = part['fileData'].get('fileUri', '')
+                    if uri.replace('stub://', '') not in files:
+                        return self._send(403, {'error': {'code': 403, 'message': f'File {uri} does not exist', 'status': 'PERMISSION_DENIED'}})
+                    references += 1
+
+        with lock:
+            counters['generate_calls'] += 1
+            counters['inline_bytes'] += inline_bytes
+            counters['file_references'] += references
+
+        time.sleep(self.latency)
+        schema = request.get('generationConfig', {}).get('responseSchema')
+        text = json.dumps(placeholder(schema) if schema else {})
+        self._send(200, {
+            'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}]
+        })
+
+    def log_message(self, format, *args):
+        print(f"[gemini-stub] {self.command} {self.path.split('?')[0]} {args[1] if len(args) > 1 else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every generateContent call')
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    print(f"Gemini stub listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,92 @@
+# Compares the old one-after-another subcollection walk with the concurrent
+# model_user_data against an in-memory Firestore stand-in.
+# Run from backend/patient: python -m benchmarks.model_user_data
+import time
+import datetime
+from collections import defaultdict
+from user_model import model_user_data, format_timestamp
+
+QUERY_LATENCY = 0.03  # seconds per Firestore round trip
+SUBCOLLECTION_COUNTS = [1, 2, 4, 8, 16]
+RUNS = 5
+
+
+class FakeDocument:
+    def __init__(self, data):
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeQuery:
+    def __init__(self, documents):
+        self._documents = documents
+
+    def order_by(self, field_path, direction=None):
+        return self
+
+    def limit(self, count):
+        return self
+
+    def stream(self):
+        time.sleep(QUERY_LATENCY)
+        return iter(self._documents[:1])
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, collection_id, documents):
+        super().__init__(documents)
+        self.id = collection_id
+
+
+class FakeUserDocument:
+    def __init__(self, collections):
+        self._collections = collections
+
+    def collections(self):
+        time.sleep(QUERY_LATENCY)
+        return iter(self._collections)
+
+
+class FakeClient:
+    def __init__(self, subcollection_count):
+        created_at = datetime.datetime(2025, 5, 11, tzinfo=datetime.timezone.utc)
+        self._user = FakeUserDocument([
+            FakeCollection(f'collection{i}', [FakeDocument({'value': i, 'created_at': created_at})])
+            for i in range(subcollection_count)
+        ])
+
+    def collection(self, name):
+        return self
+
+    def document(self, document_id):
+        return self._user
+
+
+def sequential_model_user_data(uuid, client):
+    # The implementation model_user_data replaced
+    user_model_dict = defaultdict()
+    for collection in client.collection('users').document(uuid).collections():
+        for doc in collection.order_by(field_path="created_at").limit(1).stream():
+            doc_dict = doc.to_dict()
+            doc_dict['created_at'] = format_timestamp(doc_dict['created_at'])
+            user_model_dict[collection.id] = doc_dict
+    return user_model_dict
+
+
+def timed(function, client):
+    start_time = time.perf_counter()
+    for _ in range(RUNS):
+        result = function('user', client)
+    return (time.perf_counter() - start_time) / RUNS * 1000, result
+
+
+if __name__ == "__main__":
+    print(f"{'subcollections':>14} {'sequential ms':>14} {'concurrent ms':>14} {'speedup':>8}")
+    for count in SUBCOLLECTION_COUNTS:
+        client = FakeClient(count)
+        sequential_ms, expected = timed(sequential_model_user_data, client)
+        concurrent_ms, actual = timed(model_user_data, client)
+        assert list(actual.items()) == list(expected.items())
+        print(f"{count:>14} {sequential_ms:>14.1f} {concurrent_ms:>14.1f} {sequential_ms / concurrent_ms:>7.1f}x")
@@ -0,0 +1,60 @@
+# Measures what image normalization saves on the sample photos in
+# image_data/images: size of the PDF sent inline to Gemini and, with
+# --extract <document_type>, the Gemini extraction latency.
+# Run from backend/patient: python -m benchmarks.normalize_images [--extract labData]
+import io
+import os
+import sys
+import glob
+import time
+from PIL import Image
+from image_data.normalize import normalize_image
+
+IMAGES_DIR = os.path.join(os.path.dirname(__file__), '..', 'image_data', 'images')
+
+
+def build_pdf(pages):
+    images = [Image.open(io.BytesIO(page)).convert('RGB') for page in pages]
+    output = io.BytesIO()
+    images[0].save(output, format='PDF', save_all=True, append_images=images[1:])
+    return output.getvalue()
+
+
+def extraction_seconds(pdf_bytes, document_type):
+    from image_data.gemini_api import call_gemini_api
+
+    start_time = time.perf_counter()
+    call_gemini_api(pdf_bytes, document_type)
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    document_type = sys.argv[sys.argv.index('--extract') + 1] if '--extract' in sys.argv else None
+
+    totals = {'raw': 0, 'normalized': 0, 'raw_seconds': 0.0, 'normalized_seconds': 0.0}
+    print(f"{'folder':>14} {'pages':>5} {'raw PDF MB':>11} {'norm PDF MB':>12} {'normalize ms':>13}")
+    for folder in sorted(glob.glob(os.path.join(IMAGES_DIR, 'raw-image-*')), key=lambda f: int(f.rsplit('-', 1)[1])):
+        pages = []
+        for path in sorted(glob.glob(os.path.join(folder, '*.JPG'))):
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+
+        start_time = time.perf_counter()
+        normalized = [normalize_image(page) for page in pages]
+        normalize_ms = (time.perf_counter() - start_time) * 1000
+
+        raw_pdf = build_pdf(pages)
+        normalized_pdf = build_pdf(normalized)
+        totals['raw'] += len(raw_pdf)
+        totals['normalized'] += len(normalized_pdf)
+        print(f"{os.path.basename(folder):>14} {len(pages):>5} {len(raw_pdf) / 1e6:>11.2f} {len(normalized_pdf) / 1e6:>12.2f} {normalize_ms:>13.0f}")
+
+        if document_type:
+            totals['raw_seconds'] += extraction_seconds(raw_pdf, document_type)
+            totals['normalized_seconds'] += extraction_seconds(normalized_pdf, document_type)
+
+    # Gemini receives the PDF inline with the request
+    print(f"\ninline PDF payload: {totals['raw'] / 1e6:.1f} MB -> {totals['normalized'] / 1e6:.1f} MB "
+          f"({100 * (1 - totals['normalized'] / totals['raw']):.0f}% smaller)")
+    if document_type:
+        print(f"{document_type} extraction: {totals['raw_seconds']:.1f} s -> {totals['normalized_seconds']:.1f} s")
@@ -0,0 +1,59 @@
+# Peak memory of PDF assembly for growing page counts: the old path that
+# decodes every page and calls save(save_all=True), against normalizing and
+# writing one page at a time with JpegPdfWriter. Each measurement runs in a
+# fresh process so peak RSS is not shared between runs.
+# Run from backend/patient: python -m benchmarks.pdf_memory
+import io
+import os
+import sys
+import glob
+import resource
+import tempfile
+import subprocess
+
+IMAGES_DIR = os.path.join(os.path.dirname(__file__), '..', 'image_data', 'images')
+PAGE_COUNTS = [1, 2, 5, 10, 20]
+
+
+def sample_pages(count):
+    paths = sorted(glob.glob(os.path.join(IMAGES_DIR, 'raw-image-*', '*.JPG')))
+    for i in range(count):
+        with open(paths[i % len(paths)], 'rb') as f:
+            yield io.BytesIO(f.read())
+
+
+def save_all_pdf(count, output):
+    from PIL import Image
+
+    images = [Image.open(stream).convert('RGB') for stream in sample_pages(count)]
+    images[0].save(output, format='PDF', save_all=True, append_images=images[1:])
+
+
+def streaming_pdf(count, output):
+    from image_data.normalize import normalize_images
+    from image_data.pdf_writer import JpegPdfWriter
+
+    with JpegPdfWriter(output) as pdf:
+        for normalized, _ in normalize_images(sample_pages(count)):
+            pdf.add_page(normalized)
+
+
+def peak_rss_mb(mode, count):
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.pdf_memory', mode, str(count)],
+        capture_output=True, text=True, check=True
+    )
+    return float(result.stdout)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        mode, count = sys.argv[1], int(sys.argv[2])
+        with tempfile.TemporaryFile() as output:
+            {'save_all': save_all_pdf, 'streaming': streaming_pdf}[mode](count, output)
+        # ru_maxrss is in KB on Linux
+        print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    else:
+        print(f"{'pages':>5} {'save_all MB':>12} {'streaming MB':>13}")
+        for count in PAGE_COUNTS:
+            print(f"{count:>5} {peak_rss_mb('save_all', count):>12.0f} {peak_rss_mb('streaming', count):>13.0f}")
@@ -0,0 +1,56 @@
+# Measures what audio preprocessing saves on WAV recordings: bytes uploaded
+# to Whisper and, with --transcribe (needs OPENAI_API_KEY), the transcription
+# latency of the recording as received versus trimmed, 16 kHz mono and
+# split into parts transcribed in parallel.
+# Run from backend/patient: python -m benchmarks.transcription_audio recording.wav [...] [--transcribe]
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from audio_preprocessing import prepare_for_transcription
+
+
+def transcription_seconds(client, files):
+    def transcribe(file):
+        return client.audio.transcriptions.create(model="whisper-1", file=file).text
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        list(executor.map(transcribe, files))
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    client = None
+    if '--transcribe' in sys.argv:
+        import openai
+        client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+    totals = {'raw': 0, 'prepared': 0, 'raw_seconds': 0.0, 'prepared_seconds': 0.0}
+    print(f"{'recording':>24} {'raw KB':>9} {'prepared KB':>12} {'parts':>5} {'prepare ms':>11}")
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        start_time = time.perf_counter()
+        parts = prepare_for_transcription(data)
+        prepare_ms = (time.perf_counter() - start_time) * 1000
+        if parts is None:
+            print(f"{os.path.basename(path):>24} not a readable WAV file, skipped")
+            continue
+
+        prepared = sum(len(part) for part in parts)
+        totals['raw'] += len(data)
+        totals['prepared'] += prepared
+        print(f"{os.path.basename(path):>24} {len(data) / 1e3:>9.0f} {prepared / 1e3:>12.0f} {len(parts):>5} {prepare_ms:>11.0f}")
+
+        if client and parts:
+            totals['raw_seconds'] += transcription_seconds(client, [(os.path.basename(path), data)])
+            totals['prepared_seconds'] += transcription_seconds(client, [('audio.wav', part) for part in parts])
+
+    if totals['raw']:
+        print(f"\nWhisper upload: {totals['raw'] / 1e6:.2f} MB -> {totals['prepared'] / 1e6:.2f} MB "
+              f"({100 * (1 - totals['prepared'] / totals['raw']):.0f}% smaller)")
+    if client:
+        print(f"transcription: {totals['raw_seconds']:.1f} s -> {totals['prepared_seconds']:.1f} s")
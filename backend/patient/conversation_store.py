@@ -0,0 +1,170 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+
+def estimate_tokens(text: str):
+    # About four characters per token for English, plus the per-message overhead of the chat format
+    return len(text) // 4 + 4
+
+
+class Conversation:
+    def __init__(self):
+        self.turns = []
+        self.summary = ''
+        self.size = 0
+        self.touched_at = time.monotonic()
+        # Turns that fell out of the budget and still have to go into the summary
+        self.unsummarized = []
+        self.summarizing = False
+
+
+class ConversationStore:
+    """Chat history per conversation, for the prompt of the next turn. Only
+    the most recent turns that fit token_budget are kept (the latest
+    exchange always, shortened when it alone is over), older ones are
+    folded into a short running summary by summarize(summary, turns) in the
+    background (or just dropped when there is no summarize). Conversations
+    are evicted least recently used first when there are more than maxsize
+    of them or their text exceeds max_bytes, and after ttl seconds idle."""
+
+    def __init__(self, maxsize: int, ttl: float, max_bytes: int, token_budget: int, summary_max_chars: int, summarize=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.token_budget = token_budget
+        self.summary_max_chars = summary_max_chars
+        self.summarize = summarize
+        self._conversations = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='summaries')
+
+        self.evictions = 0
+        self.truncated_turns = 0
+        self.shortened_turns = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def _resize(self, conversation):
+        size = len(conversation.summary.encode('utf-8')) + sum(len(turn['content'].encode('utf-8')) for turn in conversation.turns)
+        self._bytes += size - conversation.size
+        conversation.size = size
+
+    def _remove(self, key):
+        conversation = self._conversations.pop(key)
+        self._bytes -= conversation.size
+
+    def _expire(self):
+        now = time.monotonic()
+        # Ordered by last use, so the expired ones are all at the front
+        while self._conversations:
+            key, conversation = next(iter(self._conversations.items()))
+            if now - conversation.touched_at <= self.ttl:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _evict(self, keep):
+        while self._conversations and (len(self._conversations) > self.maxsize or self._bytes > self.max_bytes):
+            key = next(iter(self._conversations))
+            if key == keep:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def history(self, key):
+        """Returns (summary, turns) of the conversation, turns as chat messages."""
+        with self._lock:
+            self._expire()
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return '', []
+            conversation.touched_at = time.monotonic()
+            self._conversations.move_to_end(key)
+            return conversation.summary, list(conversation.turns)
+
+    def append(self, key, reply: str, message: str = None):
+        """Adds a turn: the patient's message (None for the opening question) and the reply."""
+        with self._lock:
+            self._expire()
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = Conversation()
+            conversation.touched_at = time.monotonic()
+            self._conversations.move_to_end(key)
+
+            latest = [{'role': 'assistant', 'content': reply}]
+            if message is not None:
+                latest.insert(0, {'role': 'user', 'content': message})
+            conversation.turns.extend(latest)
+
+            dropped = []
+            tokens = sum(estimate_tokens(turn['content']) for turn in conversation.turns)
+            while len(conversation.turns) > len(latest) and tokens > self.token_budget:
+                turn = conversation.turns.pop(0)
+                tokens -= estimate_tokens(turn['content'])
+                dropped.append(turn)
+            self.truncated_turns += len(dropped)
+
+            # The exchange just added is what the next turn answers to, it is shortened rather than dropped
+            if tokens > self.token_budget:
+                # Shortest first, so a short message leaves its unused share to a long reply
+                remaining = self.token_budget
+                for left, turn in enumerate(sorted(latest, key=lambda turn: len(turn['content']))):
+                    share = remaining // (len(latest) - left)
+                    if estimate_tokens(turn['content']) > share:
+                        turn['content'] = turn['content'][:max(0, (share - 4) * 4)]
+                        self.shortened_turns += 1
+                    remaining -= estimate_tokens(turn['content'])
+
+            self._resize(conversation)
+            self._evict(keep=key)
+
+            if dropped and self.summarize:
+                conversation.unsummarized.extend(dropped)
+                if not conversation.summarizing:
+                    conversation.summarizing = True
+                    self._executor.submit(self._summarize, key, conversation)
+
+    def _summarize(self, key, conversation):
+        # One summarization per conversation at a time, turns dropped meanwhile are picked up by the next round
+        while True:
+            with self._lock:
+                turns, conversation.unsummarized = conversation.unsummarized, []
+                if not turns or self._conversations.get(key) is not conversation:
+                    conversation.summarizing = False
+                    return
+                summary = conversation.summary
+
+            try:
+                summary = self.summarize(summary, turns)[:self.summary_max_chars]
+            except Exception as e:
+                print(f"Could not summarize conversation, {len(turns)} turn(s) dropped: {str(e)}")
+                with self._lock:
+                    self.summary_failures += 1
+                continue
+
+            with self._lock:
+                self.summaries += 1
+                # Evicted while summarizing: nothing to update, the summary is dropped with it
+                if self._conversations.get(key) is conversation:
+                    conversation.summary = summary
+                    self._resize(conversation)
+                    self._evict(keep=key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._conversations),
+                'maxsize': self.maxsize,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'token_budget': self.token_budget,
+                'evictions': self.evictions,
+                'truncated_turns': self.truncated_turns,
+                'shortened_turns': self.shortened_turns,
+                'summaries': self.summaries,
+                'summary_failures': self.summary_failures
+            }
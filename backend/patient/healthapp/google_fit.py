@@ -9,6 +9,7 @@ import requests
 import datetime
 from firebase_config import db
 from firebase_admin import firestore
+from patient_data import invalidate_patient_context
 
 # Load environment variables
 load_dotenv()
@@ -139,6 +140,9 @@ def save_fitness_data(user_id, steps, heart_rate, calories, distance):
             'distance': distance,
             'timestamp': firestore.SERVER_TIMESTAMP
         })
+        # Lets the doctor client pick this patient up on its next incremental sync
+        db.collection('users').document(user_id).set({'updated_at': firestore.SERVER_TIMESTAMP}, merge=True)
+        invalidate_patient_context(user_id)
         return True
     except Exception as e:
         print(f"Error saving fitness data: {e}")
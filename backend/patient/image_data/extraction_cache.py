@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from threading import Lock
+
+
+def _replace_file_path(value, file_path):
+    # Entries carry the filePath of the PDF they were extracted from, a hit for
+    # a re-submitted upload has to point at the new PDF
+    if isinstance(value, dict):
+        return {key: file_path if key == 'filePath' else _replace_file_path(item, file_path) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_replace_file_path(item, file_path) for item in value]
+    return value
+
+
+class ExtractionCache:
+    """Persistent cache of Gemini extraction results keyed by the content
+    hash of the normalized pages, the document type and the schema version.
+    Least recently used entries are evicted once the cache exceeds max_bytes."""
+
+    def __init__(self, db_path: str, max_bytes: int):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS extractions (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS extractions_last_used ON extractions (last_used)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(content_hash: str, document_type: str, schema_version: str):
+        return hashlib.sha256(f'{content_hash}:{document_type}:{schema_version}'.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM extractions WHERE key = ?', (key,)).fetchone()
+            if row:
+                conn.execute('UPDATE extractions SET last_used = ? WHERE key = ?', (time.time(), key))
+
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value):
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO extractions (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                (key, serialized, len(serialized.encode('utf-8')), time.time())
+            )
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM extractions').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            evicted = []
+            for entry_key, size in conn.execute('SELECT key, size FROM extractions ORDER BY last_used'):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((entry_key,))
+                total -= size
+            conn.executemany('DELETE FROM extractions WHERE key = ?', evicted)
+
+        with self._lock:
+            self.evictions += len(evicted)
+
+    def get_or_extract(self, content_hash, document_type, schema_version, file_path, extract):
+        key = self.key(content_hash, document_type, schema_version)
+        cached = self.get(key)
+        if cached is not None:
+            return _replace_file_path(cached, file_path)
+
+        data = extract()
+        self.put(key, data)
+        return data
+
+    def stats(self):
+        with self._connect() as conn:
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions').fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import sqlite3
+import datetime
+import requests
+from contextlib import contextmanager
+from threading import Lock
+
+# Uploaded files expire on the provider side (48 hours for Gemini), a
+# reference this close to expiry is uploaded again instead
+FILE_REF_EXPIRY_MARGIN = int(os.getenv('GEMINI_FILE_EXPIRY_MARGIN', 600))
+DEFAULT_FILE_TTL = 48 * 3600
+
+
+def _parse_expiration(value):
+    if not value:
+        return time.time() + DEFAULT_FILE_TTL
+    # The API returns RFC 3339 timestamps with up to nanosecond precision
+    value = value.rstrip('Z').split('.')[0]
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def upload_file(data: bytes, mime_type: str, display_name: str, api_key: str, endpoint: str):
+    """Uploads bytes through the Gemini Files API and returns the file resource.
+    The SDK's upload_file only takes a path and always fetches the discovery
+    document from Google, the plain REST call works from memory and against
+    a local stub endpoint."""
+    metadata = json.dumps({'file': {'displayName': display_name}})
+    response = requests.post(
+        f'{endpoint.rstrip("/")}/upload/v1beta/files',
+        params={'key': api_key, 'uploadType': 'multipart'},
+        files={
+            'metadata': (None, metadata, 'application/json; charset=UTF-8'),
+            'file': (display_name, data, mime_type)
+        },
+        timeout=120
+    )
+    response.raise_for_status()
+    return response.json()['file']
+
+
+class GeminiFileCache:
+    """Remembers which documents were already uploaded to the Files API,
+    keyed by content hash, so every later call for the same bytes sends
+    the file URI instead of the document. Stored in SQLite so all workers
+    share the uploads."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = Lock()
+        # content hash -> [lock, callers using it], removed when the last caller is done
+        self._upload_locks = {}
+        self.hits = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS gemini_files (
+                    content_hash TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    uri TEXT NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, content_hash):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT uri, mime_type FROM gemini_files WHERE content_hash = ? AND expires_at > ?',
+                (content_hash, time.time() + FILE_REF_EXPIRY_MARGIN)
+            ).fetchone()
+        return {'file_uri': row[0], 'mime_type': row[1]} if row else None
+
+    def invalidate(self, content_hash):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM gemini_files WHERE content_hash = ?', (content_hash,))
+
+    def get_or_upload(self, content_hash, upload):
+        """Returns a file_data reference for the content, calling upload()
+        (which returns the Files API resource) only when there is no live one."""
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(content_hash, [Lock(), 0])
+            upload_lock[1] += 1
+
+        try:
+            # Concurrent calls for the same document (hedges, retries) share one upload
+            with upload_lock[0]:
+                file_data = self.get(content_hash)
+                if file_data:
+                    with self._lock:
+                        self.hits += 1
+                    return file_data
+
+                resource = upload()
+                with self._connect() as conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO gemini_files (content_hash, name, uri, mime_type, expires_at) VALUES (?, ?, ?, ?, ?)',
+                        (content_hash, resource['name'], resource['uri'], resource['mimeType'], _parse_expiration(resource.get('expirationTime')))
+                    )
+                with self._lock:
+                    self.uploads += 1
+                    self.uploaded_bytes += int(resource.get('sizeBytes', 0))
+                return {'file_uri': resource['uri'], 'mime_type': resource['mimeType']}
+        finally:
+            with self._lock:
+                upload_lock[1] -= 1
+                if not upload_lock[1]:
+                    del self._upload_locks[content_hash]
+
+    def stats(self):
+        with self._connect() as conn:
+            live = conn.execute('SELECT COUNT(*) FROM gemini_files WHERE expires_at > ?', (time.time(),)).fetchone()[0]
+        with self._lock:
+            return {
+                'live_files': live,
+                'hits': self.hits,
+                'uploads': self.uploads,
+                'uploaded_bytes': self.uploaded_bytes
+            }
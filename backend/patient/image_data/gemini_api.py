@@ -12,6 +12,12 @@ from .classes.InsuranceCard import InsuranceCard
 from PIL import Image
 import io
 import base64
+import hashlib
+from threading import Lock
+from .structured_output import extract_json, to_response_schema
+from llm_scheduler import llm_scheduler, BACKGROUND, status_code
+from .file_refs import GeminiFileCache, upload_file
+from .hedging import extraction_hedger, HEDGE_EXTRACTION
 
 SCHEMA_DOCTOR_LETTER = {
     "reasonForReferral": {
@@ -254,6 +260,21 @@ SCHEMA_INSURANCE_CARD = {
    }
 }
 
+SCHEMAS = {
+  "doctorLetter": SCHEMA_DOCTOR_LETTER,
+  "medicationPlan": SCHEMA_MEDICATION_PLAN,
+  "labData": SCHEMA_LAB_DATA,
+  "insuranceCard": SCHEMA_INSURANCE_CARD
+}
+
+# Bump when the prompt or the post-processing changes what an extraction returns
+EXTRACTION_VERSION = 1
+
+def schema_version(document_type: str) -> str:
+  # Schema edits change the version on their own, cached extractions never outlive them
+  schema_hash = hashlib.sha256(json.dumps(SCHEMAS[document_type], sort_keys=True).encode('utf-8')).hexdigest()
+  return f"{EXTRACTION_VERSION}:{schema_hash[:16]}"
+
 def createMedicationPlan(json_obj, file_path) -> list[MedicationPlan]:
     medicationPlanEntries = []
     for jsonMedicationPlan in json_obj:
@@ -318,32 +339,16 @@ def createInsuranceCard(json_obj, file_path) -> InsuranceCard:
    )
    return insuranceCard
 
-def call_gemini_api(file_path: str, document_type: str):
-      
-  load_dotenv()
-
-  GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-  if not GOOGLE_API_KEY:
-    raise ValueError("GOOGLE_API_KEY environment variable is not set")
-
-  # Configure the Gemini API
-  genai.configure(api_key=GOOGLE_API_KEY)
-
-  # Initialize the model with the new version
-  model = genai.GenerativeModel('gemini-1.5-flash')
+def read_pdf(pdf):
+  # Accepts a path or an in-memory PDF. bytes are returned as they are, a bytearray
+  # or memoryview is copied into bytes once
+  if isinstance(pdf, (str, os.PathLike)):
+    with open(pdf, 'rb') as f:
+      return f.read()
+  return pdf if isinstance(pdf, bytes) else bytes(pdf)
 
-  if (document_type == "doctorLetter"):
-    SCHEMA = SCHEMA_DOCTOR_LETTER
-  elif (document_type == "medicationPlan"):
-    SCHEMA = SCHEMA_MEDICATION_PLAN
-  elif (document_type == "labData"):
-    SCHEMA = SCHEMA_LAB_DATA
-  elif (document_type == "insuranceCard"):
-     SCHEMA = SCHEMA_INSURANCE_CARD
-  else:
-    raise ValueError("Invalid document type. Must be 'doctorLetter', 'medicationPlan', 'labData', or 'insuranceCard'.")
-
-  PROMPT = f"""
+def render_prompt(schema) -> str:
+  return f"""
     You are an expert medical document analysis tool. Your task is to analyze the provided PDF document and extract information.
 
     Follow these rules strictly:
@@ -352,7 +357,7 @@ def call_gemini_api(file_path: str, document_type: str):
     * If a field cannot be determined from the document, set its value to "none".
     * ALWAYS return valid JSON format.
     The valid JSON format must follow the schema provided below.
-    {json.dumps(SCHEMA)}
+    {json.dumps(schema)}
     Return the JSON object in a format that can be easily parsed by a computer program.
     * Do not include any explanations or additional text outside the JSON object.
     * Do not include any comments in the JSON object.
@@ -363,67 +368,223 @@ def call_gemini_api(file_path: str, document_type: str):
     * Do not include any HTML or XML tags in the JSON object.
     Analyze the provided PDF now.
     """
+
+# Rendered once at import instead of on every call
+PROMPTS = {document_type: render_prompt(schema) for document_type, schema in SCHEMAS.items()}
+
+# Constrain Gemini to JSON matching the document schema
+STRUCTURED_OUTPUT = os.getenv('EXTRACTION_STRUCTURED_OUTPUT', 'true').lower() == 'true'
+RESPONSE_SCHEMAS = {document_type: to_response_schema(schema) for document_type, schema in SCHEMAS.items()}
+
+# Malformed output is sent back for repair this many times before giving up
+REPAIR_ATTEMPTS = int(os.getenv('EXTRACTION_REPAIR_ATTEMPTS', 2))
+
+# Upload each PDF once through the Files API and send only its URI on every later call
+GEMINI_FILE_API = os.getenv('GEMINI_FILE_API', 'false').lower() == 'true'
+# Points the SDK and the uploads at another endpoint, e.g. benchmarks/gemini_stub_server.py
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')
+gemini_files = GeminiFileCache(os.getenv('GEMINI_FILE_CACHE_PATH', 'cache/gemini_files.sqlite3'))
+
+REPAIR_PROMPT = """
+    The following text was supposed to be a single JSON object following the schema below, but it could not be parsed.
+    {schema}
+    Return only the corrected JSON object, without explanations, comments or code fences. Do not change any values.
+    Text:
+    {output}
+    """
+
+class ExtractionStats:
+  def __init__(self):
+    self._lock = Lock()
+    self.responses = 0
+    self.parse_failures = 0
+    self.repair_calls = 0
+    self.repaired = 0
+    self.parse_seconds = 0.0
+
+  def record(self, seconds: float, repair_calls: int, parsed: bool):
+    with self._lock:
+      self.responses += 1
+      self.parse_seconds += seconds
+      self.repair_calls += repair_calls
+      if repair_calls and parsed:
+        self.repaired += 1
+      if not parsed:
+        self.parse_failures += 1
+
+  def stats(self):
+    with self._lock:
+      return {
+        'responses': self.responses,
+        'repair_calls': self.repair_calls,
+        'repaired': self.repaired,
+        'parse_failures': self.parse_failures,
+        'retry_rate': self.repair_calls / self.responses if self.responses else 0.0,
+        'avg_parse_seconds': self.parse_seconds / self.responses if self.responses else 0.0
+      }
+
+extraction_stats = ExtractionStats()
+
+class ExtractionEngine:
+  """Holds the configured Gemini model for the lifetime of the worker. It is
+  created on first use rather than at import, so a forking server (gunicorn)
+  builds it inside each worker instead of sharing one client across forks."""
+
+  def __init__(self, model_name: str = 'gemini-1.5-flash'):
+    self.model_name = model_name
+    self._model = None
+    self._api_key = None
+    self._lock = Lock()
+
+  @property
+  def api_key(self):
+    # Resolved on its own, the Files API upload in pdf_part needs it without the model
+    if self._api_key is None:
+      load_dotenv()
+      api_key = os.getenv("GOOGLE_API_KEY")
+      if not api_key:
+        raise ValueError("GOOGLE_API_KEY environment variable is not set")
+      self._api_key = api_key
+    return self._api_key
+
+  @property
+  def model(self):
+    if self._model is None:
+      with self._lock:
+        if self._model is None:
+          # Configure the Gemini API
+          if GEMINI_API_ENDPOINT:
+            genai.configure(api_key=self.api_key, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+          else:
+            genai.configure(api_key=self.api_key)
+          self._model = genai.GenerativeModel(self.model_name)
+    return self._model
+
+  def prompt(self, document_type: str) -> str:
+    if document_type not in PROMPTS:
+      raise ValueError("Invalid document type. Must be 'doctorLetter', 'medicationPlan', 'labData', or 'insuranceCard'.")
+    return PROMPTS[document_type]
+
+  def pdf_part(self, pdf_data: bytes):
+    if not GEMINI_FILE_API:
+      return {"inline_data": {"mime_type": "application/pdf", "data": pdf_data}}
+
+    content_hash = hashlib.sha256(pdf_data).hexdigest()
+    endpoint = GEMINI_API_ENDPOINT or 'https://generativelanguage.googleapis.com'
+    upload = lambda: upload_file(pdf_data, 'application/pdf', f'{content_hash}.pdf', self.api_key, endpoint)
+    return {"file_data": gemini_files.get_or_upload(content_hash, lambda: llm_scheduler.call('gemini', upload, BACKGROUND))}
+
+  def generation_config(self, document_type: str):
+    if not STRUCTURED_OUTPUT:
+      return None
+    return {
+      "response_mime_type": "application/json",
+      "response_schema": RESPONSE_SCHEMAS[document_type]
+    }
+
+  def parse_response(self, response_text: str, document_type: str):
+    # Parse errors are fixed by sending only the broken text back to the
+    # model, the document itself is never uploaded again
+    start_time = time.perf_counter()
+    repair_calls = 0
+    parsed = False
+    try:
+      while True:
+        try:
+          json_obj = extract_json(response_text)
+          parsed = True
+          return json_obj
+        except ValueError:
+          if repair_calls >= REPAIR_ATTEMPTS:
+            raise
+          repair_calls += 1
+          print(f"Could not parse {document_type} response, requesting repair {repair_calls}/{REPAIR_ATTEMPTS}")
+          repair_prompt = REPAIR_PROMPT.format(schema=json.dumps(SCHEMAS[document_type]), output=response_text)
+          response_text = llm_scheduler.call(
+            'gemini', lambda: self.model.generate_content(repair_prompt, generation_config=self.generation_config(document_type)), BACKGROUND
+          ).text
+    finally:
+      extraction_stats.record(time.perf_counter() - start_time, repair_calls, parsed)
+
+extraction_engine = ExtractionEngine()
+
+def extract_json_obj(pdf, document_type: str):
+  # One Gemini round trip, returns the parsed JSON before it is mapped onto the document classes
+  PROMPT = extraction_engine.prompt(document_type)
+  model = extraction_engine.model
  
   start_time = time.time()
   
+  # The bytes go straight into the request, no base64 copy is needed
+  pdf_data = read_pdf(pdf)
+
+  # Create the content parts for Gemini API, the PDF goes inline or as an uploaded file reference
+  content_parts = [
+    {"text": PROMPT},
+    extraction_engine.pdf_part(pdf_data)
+  ]
+  
+  # Generate content using the model, extraction yields to interactive calls. Only the
+  # provider call itself is timed for the hedging threshold, not the wait in the scheduler
+  def request():
+    return llm_scheduler.call('gemini', extraction_hedger.timed(
+      lambda: model.generate_content(content_parts, generation_config=extraction_engine.generation_config(document_type))
+    ), BACKGROUND)
+
   try:
-    # Read the PDF file and convert to base64
-    with open(file_path, 'rb') as f:
-      pdf_data = f.read()
-      pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
-    
-    # Create the content parts for Gemini API
-    content_parts = [
-      {"text": PROMPT},
-      {
-        "inline_data": {
-          "mime_type": "application/pdf",
-          "data": pdf_base64
-        }
-      }
-    ]
-    
-    # Generate content using the model
-    response = model.generate_content(content_parts)
-    
-    end_time = time.time()
-    print(f"Time taken: {end_time - start_time} seconds")
-
-    response_text = response.text
-
-    responses = response_text.split("\n")
-    json_response = responses[1]
-
-    json_obj = json.loads(json_response)
-    print("Gemini API Response:", json.dumps(json_obj, indent=2))  # Debug log
-
-    if (document_type == "doctorLetter"):
-      return createDoctorLetter(json_obj, file_path).to_dict()
-    elif (document_type == "medicationPlan"):
-       return [medicationPlan.to_dict() for medicationPlan in createMedicationPlan(json_obj["medication"], file_path)]
-    elif (document_type == "labData"):
-      try:
-        print("Lab Data Response Structure:", json.dumps(json_obj, indent=2))
-        # For lab data, we need to access the labData array from the response
-        lab_data = json_obj.get("labData", [])
-        if not isinstance(lab_data, list):
-            lab_data = [lab_data]  # Convert single object to list if needed
-        print("Lab Data Array:", json.dumps(lab_data, indent=2))
-        return [labData.to_dict() for labData in createLabData(lab_data, file_path)]
-      except Exception as e:
-        print(f"Error processing lab data: {e}")
-        print(f"Full response structure: {json.dumps(json_obj, indent=2)}")
-        print(f"Error type: {type(e)}")
-        print(f"Error details: {str(e)}")
-        raise
-    elif (document_type == 'insuranceCard'):
-       return createInsuranceCard(json_obj, file_path).to_dict()
-    else:
-      raise ValueError("Invalid document type. Must be 'doctorLetter', 'medicationPlan', 'labData', or 'insuranceCard'.")
+    response = extraction_hedger.call(request) if HEDGE_EXTRACTION else request()
+  except Exception as e:
+    # A cached reference to a file the provider already deleted, upload it again once
+    if not GEMINI_FILE_API or status_code(e) not in (403, 404):
+      raise
+    gemini_files.invalidate(hashlib.sha256(pdf_data).hexdigest())
+    content_parts[1] = extraction_engine.pdf_part(pdf_data)
+    response = request()
+  
+  end_time = time.time()
+  print(f"Time taken: {end_time - start_time} seconds")
+
+  json_obj = extraction_engine.parse_response(response.text, document_type)
+  print("Gemini API Response:", json.dumps(json_obj, indent=2))  # Debug log
+  return json_obj
+
+def call_gemini_api(pdf, document_type: str, file_path: str = None):
+  # file_path is only recorded on the extracted entries, it defaults to pdf when that is a path
+  if file_path is None and isinstance(pdf, (str, os.PathLike)):
+    file_path = str(pdf)
+
+  try:
+    json_obj = extract_json_obj(pdf, document_type)
+    return to_document_dict(json_obj, document_type, file_path)
   except Exception as e:
     print(f"Error in call_gemini_api: {e}")
     raise
 
+def to_document_dict(json_obj, document_type: str, file_path: str):
+  if (document_type == "doctorLetter"):
+    return createDoctorLetter(json_obj, file_path).to_dict()
+  elif (document_type == "medicationPlan"):
+     return [medicationPlan.to_dict() for medicationPlan in createMedicationPlan(json_obj["medication"], file_path)]
+  elif (document_type == "labData"):
+    try:
+      print("Lab Data Response Structure:", json.dumps(json_obj, indent=2))
+      # For lab data, we need to access the labData array from the response
+      lab_data = json_obj.get("labData", [])
+      if not isinstance(lab_data, list):
+          lab_data = [lab_data]  # Convert single object to list if needed
+      print("Lab Data Array:", json.dumps(lab_data, indent=2))
+      return [labData.to_dict() for labData in createLabData(lab_data, file_path)]
+    except Exception as e:
+      print(f"Error processing lab data: {e}")
+      print(f"Full response structure: {json.dumps(json_obj, indent=2)}")
+      print(f"Error type: {type(e)}")
+      print(f"Error details: {str(e)}")
+      raise
+  elif (document_type == 'insuranceCard'):
+     return createInsuranceCard(json_obj, file_path).to_dict()
+  else:
+    raise ValueError("Invalid document type. Must be 'doctorLetter', 'medicationPlan', 'labData', or 'insuranceCard'.")
+
 
 if __name__ == "__main__":
   # Example usage
@@ -0,0 +1,182 @@
+import os
+import time
+from collections import deque
+from threading import Lock, Condition, local
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+HEDGE_EXTRACTION = os.getenv('HEDGE_EXTRACTION', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+HEDGE_WINDOW = int(os.getenv('HEDGE_WINDOW', 200))
+HEDGE_MAX_IN_FLIGHT = int(os.getenv('HEDGE_MAX_IN_FLIGHT', 2))
+# Runs the primary calls as well as the hedges
+HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', 16))
+
+
+class RollingLatency:
+    """Latencies of the most recent successful calls in this worker."""
+
+    def __init__(self, window: int):
+        self._samples = deque(maxlen=window)
+        self._lock = Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percentile: float, min_samples: int):
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class Attempt:
+    """When the provider call of one hedged request is running. started_at is
+    None while the request waits in the scheduler or backs off between retries."""
+
+    def __init__(self):
+        self.started_at = None
+        self.finished = False
+        self.condition = Condition()
+
+    def _set(self, **fields):
+        with self.condition:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.condition.notify_all()
+
+    def start(self):
+        self._set(started_at=time.monotonic())
+
+    def pause(self):
+        self._set(started_at=None)
+
+    def finish(self):
+        self._set(finished=True)
+
+    def wait_running(self, seconds: float):
+        """Waits until the provider call has been running for seconds in one go,
+        returns False when the request finished before that."""
+        with self.condition:
+            while not self.finished:
+                if self.started_at is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.started_at + seconds - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self.condition.wait(remaining)
+            return False
+
+
+class Hedger:
+    """Runs a call and, when it is still outstanding after the given
+    percentile of recent latencies, issues an identical second call. The
+    first successful response wins, the other one is left to finish and is
+    ignored. At most max_in_flight hedges run at once. Latencies and the
+    hedge timer both come from functions wrapped with timed(), which should
+    wrap only the provider call: time queued in the scheduler or backing off
+    neither raises the threshold nor counts towards it."""
+
+    def __init__(self, percentile: float, min_samples: int, window: int, max_in_flight: int, workers: int):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_in_flight = max_in_flight
+        self.latency = RollingLatency(window)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hedging')
+        self._lock = Lock()
+        self._hedges_in_flight = 0
+        # The attempt of the call running in this thread, for timed()
+        self._local = local()
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+
+    def timed(self, fn):
+        def run():
+            attempt = getattr(self._local, 'attempt', None)
+            if attempt:
+                attempt.start()
+            start_time = time.perf_counter()
+            try:
+                result = fn()
+            except Exception:
+                # A retry waits for the scheduler again, the timer restarts with its provider call
+                if attempt:
+                    attempt.pause()
+                raise
+            self.latency.record(time.perf_counter() - start_time)
+            return result
+        return run
+
+    def _attempt(self, fn, attempt):
+        self._local.attempt = attempt
+        try:
+            return fn()
+        finally:
+            self._local.attempt = None
+
+    def _start_hedge(self):
+        with self._lock:
+            if self._hedges_in_flight >= self.max_in_flight:
+                self.skipped += 1
+                return False
+            self._hedges_in_flight += 1
+            self.hedges += 1
+            return True
+
+    def _hedge_done(self, future):
+        with self._lock:
+            self._hedges_in_flight -= 1
+
+    def call(self, fn):
+        with self._lock:
+            self.calls += 1
+        threshold = self.latency.percentile(self.percentile, self.min_samples)
+        # Until there is enough history there is nothing to compare against
+        if threshold is None:
+            return fn()
+
+        attempt = Attempt()
+        primary = self._executor.submit(self._attempt, fn, attempt)
+        primary.add_done_callback(lambda future: attempt.finish())
+        # The timer starts with the provider call, not at submit, so a backlog in the scheduler causes no hedges
+        if not attempt.wait_running(threshold) or not self._start_hedge():
+            return primary.result()
+
+        print(f"Extraction still running after {threshold:.1f}s, sending a hedged request")
+        hedge = self._executor.submit(fn)
+        hedge.add_done_callback(self._hedge_done)
+
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            # A failed request only counts once the other one has failed too
+            if succeeded or not pending:
+                winner = (succeeded or list(done))[0]
+                if winner is hedge and succeeded:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return winner.result()
+
+    def stats(self):
+        threshold = self.latency.percentile(self.percentile, self.min_samples)
+        with self._lock:
+            return {
+                'enabled': HEDGE_EXTRACTION,
+                'percentile': self.percentile,
+                'threshold_seconds': threshold,
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'hedges_in_flight': self._hedges_in_flight,
+                'skipped_at_cap': self.skipped
+            }
+
+
+extraction_hedger = Hedger(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_WINDOW, HEDGE_MAX_IN_FLIGHT, HEDGE_WORKERS)
@@ -1,6 +1,6 @@
 import os
-from PIL import Image
 import shutil
+from pdf_writer import JpegPdfWriter
 def jpgs_to_pdfs(input_folders, output_folder):
      # Prepare output directory
     if os.path.exists(output_folder):
@@ -20,16 +20,15 @@ def jpgs_to_pdfs(input_folders, output_folder):
         jpg_files = sorted(
             [f for f in os.listdir(folder) if f.lower().endswith(".jpeg")]
         )
-        image_list = []
 
-        for jpg in jpg_files:
-            path = os.path.join(folder, jpg)
-            img = Image.open(path).convert("RGB").rotate(-90, expand=True)
-            image_list.append(img)
-
-        if image_list:
+        if jpg_files:
+            # Pages are written one at a time and embedded without decoding,
+            # the quarter turn clockwise is applied by the PDF page itself
             output_path = os.path.join(output_folder, f"image-{counter}.pdf")
-            image_list[0].save(output_path, save_all=True, append_images=image_list[1:])
+            with open(output_path, "wb") as f, JpegPdfWriter(f) as pdf:
+                for jpg in jpg_files:
+                    with open(os.path.join(folder, jpg), "rb") as page:
+                        pdf.add_page(page.read(), rotate=90)
             print(f"Saved: {output_path}")
             counter += 1
         else:
@@ -0,0 +1,33 @@
+import io
+import os
+import math
+from PIL import Image, ImageOps
+
+# A4 at ~170 DPI, plenty for Gemini to read printed letters and lab tables
+NORMALIZE_LONG_EDGE = int(os.getenv('NORMALIZE_LONG_EDGE', 2000))
+NORMALIZE_JPEG_QUALITY = int(os.getenv('NORMALIZE_JPEG_QUALITY', 80))
+NORMALIZE_GRAYSCALE = os.getenv('NORMALIZE_GRAYSCALE', 'false').lower() == 'true'
+
+
+def normalize_image(image_bytes: bytes, long_edge: int = NORMALIZE_LONG_EDGE, quality: int = NORMALIZE_JPEG_QUALITY, grayscale: bool = NORMALIZE_GRAYSCALE) -> bytes:
+    """Turns a raw phone photo into an upright, downscaled JPEG ready to be
+    embedded into the PDF and sent to Gemini."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Let the JPEG decoder downscale by a power of two while decoding,
+        # as long as the result stays at least as large as the target
+        scale = min(1.0, long_edge / max(img.size))
+        img.draft('L' if grayscale else 'RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert('L' if grayscale else 'RGB')
+        img.thumbnail((long_edge, long_edge), Image.LANCZOS)
+
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+
+
+def normalize_images(image_streams, **options):
+    # Yields (normalized_bytes, original_size) so callers can report the savings
+    for stream in image_streams:
+        image_bytes = stream.read()
+        yield normalize_image(image_bytes, **options), len(image_bytes)
@@ -0,0 +1,70 @@
+import io
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from .pdf_writer import JpegPdfWriter
+from .gemini_api import SCHEMAS, extract_json_obj, to_document_dict
+
+# Long letters and lab reports are split into page groups that are extracted
+# concurrently, shorter documents and the other types stay single-shot
+PARALLEL_DOCUMENT_TYPES = {'doctorLetter', 'labData'}
+PARALLEL_EXTRACTION_MIN_PAGES = int(os.getenv('PARALLEL_EXTRACTION_MIN_PAGES', 4))
+PAGES_PER_GROUP = int(os.getenv('PAGES_PER_GROUP', 2))
+PAGE_EXTRACTION_WORKERS = int(os.getenv('PAGE_EXTRACTION_WORKERS', 4))
+
+_page_executor = ThreadPoolExecutor(max_workers=PAGE_EXTRACTION_WORKERS, thread_name_prefix='page-extraction')
+
+# Values the prompt tells the model to use for fields it couldn't find
+EMPTY_VALUES = (None, '', 'none', 'None', 'null', [], {})
+
+
+def use_parallel_extraction(document_type: str, page_count: int) -> bool:
+    return document_type in PARALLEL_DOCUMENT_TYPES and page_count >= PARALLEL_EXTRACTION_MIN_PAGES
+
+
+def _group_pdf(pages):
+    pdf_buffer = io.BytesIO()
+    with JpegPdfWriter(pdf_buffer) as pdf:
+        for page in pages:
+            pdf.add_page(page)
+    return pdf_buffer.getvalue()
+
+
+def _ordered_union(lists):
+    # Keeps the first occurrence of every entry, in page order
+    seen = set()
+    merged = []
+    for items in lists:
+        if not isinstance(items, list):
+            items = [items]
+        for item in items:
+            key = json.dumps(item, sort_keys=True, ensure_ascii=False)
+            if key not in seen:
+                seen.add(key)
+                merged.append(item)
+    return merged
+
+
+def merge_extractions(json_objs, document_type: str):
+    """Merges per-group extractions in page order: list fields (labData rows,
+    medication entries, anamnesis, plan, ...) are concatenated and deduplicated,
+    every other field takes the first value that was actually found."""
+    merged = {}
+    for field in SCHEMAS[document_type]:
+        if field == 'required':
+            continue
+        values = [json_obj[field] for json_obj in json_objs if json_obj.get(field) not in EMPTY_VALUES]
+        if any(isinstance(value, list) for value in values):
+            merged[field] = _ordered_union(values)
+        else:
+            merged[field] = values[0] if values else json_objs[0].get(field)
+    return merged
+
+
+def extract_in_page_groups(pages, document_type: str, file_path: str):
+    groups = [pages[i:i + PAGES_PER_GROUP] for i in range(0, len(pages), PAGES_PER_GROUP)]
+    print(f"Extracting {document_type} from {len(pages)} pages in {len(groups)} parallel groups")
+
+    # map() returns results in group order no matter which call finishes first
+    json_objs = list(_page_executor.map(lambda group: extract_json_obj(_group_pdf(group), document_type), groups))
+    return to_document_dict(merge_extractions(json_objs, document_type), document_type, file_path)
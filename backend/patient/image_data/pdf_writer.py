@@ -0,0 +1,124 @@
+# Minimal PDF writer that embeds JPEG pages as they are (DCTDecode passthrough)
+# and writes each page out as soon as it is added, so building a PDF never
+# needs more than one page in memory and never re-encodes pixels.
+
+# Start-of-frame markers carry the image dimensions (C4, C8 and CC are not SOFs)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+COLOR_SPACES = {1: b'/DeviceGray', 3: b'/DeviceRGB', 4: b'/DeviceCMYK'}
+
+
+def jpeg_info(data) -> tuple:
+    """Returns (width, height, components) read from the JPEG frame header."""
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("Not a JPEG image")
+
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length field
+            i += 2
+            continue
+
+        if marker in SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return width, height, data[i + 9]
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+
+    raise ValueError("No frame header found in JPEG")
+
+
+class JpegPdfWriter:
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._position = 0
+        self._offsets = {}
+        self._page_ids = []
+        # (start, end) of every embedded JPEG in the written output, so pages
+        # can be sliced back out of the finished PDF without keeping copies
+        self.page_spans = []
+        # 1 is the catalog, 2 the page tree, both written on close()
+        self._next_id = 3
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._position += len(data)
+
+    def _allocate(self):
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def _write_object(self, object_id, *parts):
+        self._offsets[object_id] = self._position
+        self._write(b'%d 0 obj\n' % object_id)
+        for part in parts:
+            self._write(part)
+        self._write(b'\nendobj\n')
+
+    def add_page(self, jpeg, rotate: int = 0):
+        # rotate turns the page clockwise in steps of 90 degrees through the
+        # drawing matrix, so even rotated pages keep their original JPEG stream
+        if rotate % 90:
+            raise ValueError("rotate must be a multiple of 90")
+        width, height, components = jpeg_info(jpeg)
+        if components not in COLOR_SPACES:
+            raise ValueError(f"Unsupported JPEG with {components} components")
+
+        image_id, content_id, page_id = self._allocate(), self._allocate(), self._allocate()
+
+        # Adobe CMYK JPEGs are stored inverted
+        decode = b' /Decode [1 0 1 0 1 0 1 0]' if components == 4 else b''
+        header = (
+            b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode%s /Length %d >>\nstream\n'
+            % (width, height, COLOR_SPACES[components], decode, len(jpeg))
+        )
+        start = self._position + len(b'%d 0 obj\n' % image_id) + len(header)
+        self._write_object(image_id, header, jpeg, b'\nendstream')
+        self.page_spans.append((start, start + len(jpeg)))
+
+        # One image point per pixel, the same page geometry PIL produces at 72 DPI
+        matrix, page_width, page_height = {
+            0: ((width, 0, 0, height, 0, 0), width, height),
+            90: ((0, -width, height, 0, 0, width), height, width),
+            180: ((-width, 0, 0, -height, width, height), width, height),
+            270: ((0, width, -height, 0, height, 0), height, width)
+        }[rotate % 360]
+        content = b'q %d %d %d %d %d %d cm /Im0 Do Q' % matrix
+        self._write_object(content_id, b'<< /Length %d >>\nstream\n' % len(content), content, b'\nendstream')
+
+        self._write_object(
+            page_id,
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+            % (page_width, page_height, image_id, content_id)
+        )
+        self._page_ids.append(page_id)
+
+    def close(self):
+        if not self._page_ids:
+            raise ValueError("No images found")
+
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in self._page_ids)
+        self._write_object(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._page_ids)))
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref_offset = self._position
+        self._write(b'xref\n0 %d\n0000000000 65535 f \n' % self._next_id)
+        for object_id in range(1, self._next_id):
+            self._write(b'%010d 00000 n \n' % self._offsets[object_id])
+        self._write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (self._next_id, xref_offset))
@@ -0,0 +1,81 @@
+import os
+import uuid
+import shutil
+import hashlib
+from threading import Lock
+
+
+def _hashed(*parts):
+    return hashlib.sha256('/'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ImageStaging:
+    """Bounded on-disk copy of recently uploaded pages, keyed by
+    (user_id, image_type, uuid), so a conversion right after the upload can
+    skip downloading the same bytes back from Firebase Storage. Least recently
+    used pages are evicted once the staging area grows past max_bytes."""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _upload_dir(self, user_id, image_type, upload_uuid):
+        # Hashing keeps request-supplied names from escaping the staging root
+        return os.path.join(self.root, _hashed(user_id, image_type, upload_uuid))
+
+    def put(self, user_id, image_type, upload_uuid, filename, data: bytes):
+        upload_dir = self._upload_dir(user_id, image_type, upload_uuid)
+        os.makedirs(upload_dir, exist_ok=True)
+
+        # Write then rename so a concurrent reader never sees a partial page
+        tmp_path = os.path.join(upload_dir, f'.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(upload_dir, _hashed(filename)))
+
+        self._evict()
+
+    def get(self, user_id, image_type, upload_uuid, filename, size=None):
+        path = os.path.join(self._upload_dir(user_id, image_type, upload_uuid), _hashed(filename))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        # Treat a page that doesn't match the stored object as a miss
+        if size is not None and len(data) != size:
+            return None
+        return data
+
+    def discard(self, user_id, image_type, upload_uuid):
+        shutil.rmtree(self._upload_dir(user_id, image_type, upload_uuid), ignore_errors=True)
+
+    def _evict(self):
+        with self._lock:
+            pages = []
+            total = 0
+            for entry in os.scandir(self.root):
+                if not entry.is_dir():
+                    continue
+                for page in os.scandir(entry.path):
+                    try:
+                        stat = page.stat()
+                    except FileNotFoundError:
+                        continue
+                    pages.append((stat.st_mtime, stat.st_size, page.path))
+                    total += stat.st_size
+
+            for _, size, path in sorted(pages):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    # Missing page, or the upload directory still has pages
+                    pass
+                total -= size
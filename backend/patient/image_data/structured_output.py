@@ -0,0 +1,62 @@
+import re
+import json
+
+FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+
+
+def extract_json(text: str):
+    """Pulls the JSON value out of a model response. Handles bare JSON, code
+    fences, prose before the JSON and trailing text after it."""
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    candidates = [match.strip() for match in FENCE.findall(text)] + [text]
+    decoder = json.JSONDecoder()
+    for candidate in candidates:
+        for start, char in enumerate(candidate):
+            if char not in '{[':
+                continue
+            try:
+                value, _ = decoder.raw_decode(candidate, start)
+                return value
+            except ValueError:
+                continue
+
+    raise ValueError("No JSON object found in model response")
+
+
+def _response_property(definition):
+    # Our schemas use JSON Schema style ["string", "null"] unions, the Gemini
+    # response schema wants a single type plus nullable
+    converted = {}
+    field_type = definition.get('type')
+    if isinstance(field_type, list):
+        converted['type'] = next(t for t in field_type if t != 'null')
+        if 'null' in field_type:
+            converted['nullable'] = True
+    elif field_type:
+        converted['type'] = field_type
+
+    if 'description' in definition:
+        converted['description'] = definition['description']
+    if 'items' in definition:
+        converted['items'] = _response_property(definition['items'])
+    if 'properties' in definition:
+        converted['properties'] = {name: _response_property(item) for name, item in definition['properties'].items()}
+    if 'required' in definition:
+        converted['required'] = list(definition['required'])
+    return converted
+
+
+def to_response_schema(schema):
+    """Turns one of the SCHEMA_* property maps into the object schema Gemini
+    uses to constrain its JSON output."""
+    properties = {name: _response_property(definition) for name, definition in schema.items() if name != 'required'}
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(schema.get('required', properties))
+    }
@@ -0,0 +1,207 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# A running job holds a lease that its worker renews every JOB_HEARTBEAT_SECONDS,
+# once the lease has run out the worker is gone and the job is queued again
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 60))
+JOB_HEARTBEAT_SECONDS = int(os.getenv('JOB_HEARTBEAT_SECONDS', 15))
+# How often every worker looks for expired leases and queued jobs nobody runs
+JOB_REAP_SECONDS = int(os.getenv('JOB_REAP_SECONDS', 30))
+
+
+class JobQueue:
+    """Runs conversion jobs on a bounded thread pool and keeps their state in
+    SQLite, so queued and interrupted jobs survive a worker restart."""
+
+    def __init__(self, db_path: str, handler, max_workers: int):
+        self.db_path = db_path
+        self.handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jobs')
+        # Identifies this process as the holder of a lease
+        self.owner = uuid.uuid4().hex
+        # Jobs submitted to this executor that have not started yet, so the reaper does not queue them twice
+        self._submitted = set()
+        self._submitted_lock = threading.Lock()
+        self._reaper = None
+
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    image_type TEXT NOT NULL,
+                    uuid TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    pdf_url TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+            if 'batch_id' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN batch_id TEXT')
+            if 'lease_owner' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN lease_owner TEXT')
+                conn.execute('ALTER TABLE jobs ADD COLUMN lease_until REAL')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_batch_id ON jobs (batch_id)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def submit(self, user_id, image_type, upload_uuid):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, user_id, image_type, uuid, status, stage, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, user_id, image_type, upload_uuid, JOB_QUEUED, JOB_QUEUED, now, now)
+            )
+        self._enqueue(job_id)
+        return job_id
+
+    def submit_batch(self, user_id, documents):
+        # All jobs of a batch share the pool, so they run side by side up to max_workers
+        batch_id = uuid.uuid4().hex
+        job_ids = [uuid.uuid4().hex for _ in documents]
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT INTO jobs (id, user_id, image_type, uuid, status, stage, batch_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(job_id, user_id, image_type, upload_uuid, JOB_QUEUED, JOB_QUEUED, batch_id, now, now)
+                 for job_id, (image_type, upload_uuid) in zip(job_ids, documents)]
+            )
+        for job_id in job_ids:
+            self._enqueue(job_id)
+        return batch_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_batch(self, batch_id):
+        # Finished jobs first, in the order they finished, then the ones still pending
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                'SELECT * FROM jobs WHERE batch_id = ? ORDER BY status NOT IN (?, ?), updated_at, created_at',
+                (batch_id, JOB_DONE, JOB_FAILED)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _enqueue(self, job_id):
+        with self._submitted_lock:
+            if job_id in self._submitted:
+                return False
+            self._submitted.add(job_id)
+        self._executor.submit(self._run, job_id)
+        return True
+
+    def _update(self, job_id, **fields):
+        # Only the lease holder writes, a worker whose lease was taken over leaves the job alone
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f'UPDATE jobs SET {assignments} WHERE id = ? AND lease_owner = ?',
+                (*fields.values(), job_id, self.owner)
+            )
+            return cursor.rowcount == 1
+
+    def _claim(self, job_id):
+        # Several gunicorn workers share the database, only one may run a job
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET status = ?, lease_owner = ?, lease_until = ?, updated_at = ? WHERE id = ? AND status = ?',
+                (JOB_RUNNING, self.owner, now + JOB_LEASE_SECONDS, now, job_id, JOB_QUEUED)
+            )
+            return cursor.rowcount == 1
+
+    def _heartbeat(self, job_id, finished):
+        # Renews the lease while the handler runs, a single stage can take longer than the lease
+        while not finished.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                self._update(job_id, lease_until=time.time() + JOB_LEASE_SECONDS)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not renew the lease of job {job_id}: {str(e)}")
+
+    def _run(self, job_id):
+        with self._submitted_lock:
+            self._submitted.discard(job_id)
+        if not self._claim(job_id):
+            return
+        job = self.get(job_id)
+
+        def set_stage(stage):
+            self._update(job_id, stage=stage, lease_until=time.time() + JOB_LEASE_SECONDS)
+
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, finished), daemon=True)
+        heartbeat.start()
+        try:
+            pdf_url = self.handler(job, set_stage)
+            self._update(job_id, status=JOB_DONE, stage=JOB_DONE, pdf_url=pdf_url, lease_until=None)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            self._update(job_id, status=JOB_FAILED, error=str(e), lease_until=None)
+        finally:
+            finished.set()
+
+    def resume_pending(self):
+        """Queues the running jobs whose lease has run out again, then submits
+        every queued job this process has not submitted yet. Returns how many
+        were submitted."""
+        with self._connect() as conn:
+            # Jobs from before leases existed have none and count as expired
+            conn.execute(
+                'UPDATE jobs SET status = ?, stage = ?, lease_owner = NULL, lease_until = NULL '
+                'WHERE status = ? AND (lease_until IS NULL OR lease_until < ?)',
+                (JOB_QUEUED, JOB_QUEUED, JOB_RUNNING, time.time())
+            )
+            job_ids = [row[0] for row in conn.execute('SELECT id FROM jobs WHERE status = ? ORDER BY created_at', (JOB_QUEUED,))]
+
+        return sum(self._enqueue(job_id) for job_id in job_ids)
+
+    def _reap(self, interval):
+        while True:
+            try:
+                resumed = self.resume_pending()
+                if resumed:
+                    logger.info(f"Resumed {resumed} queued or abandoned job(s)")
+            except sqlite3.Error as e:
+                logger.error(f"Could not resume pending jobs: {str(e)}")
+            time.sleep(interval)
+
+    def start_reaper(self, interval: float = JOB_REAP_SECONDS):
+        # Runs for the lifetime of the process, so jobs of a worker that dies later are picked up too
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, args=(interval,), daemon=True, name='jobs-reaper')
+            self._reaper.start()
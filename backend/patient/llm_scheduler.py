@@ -0,0 +1,257 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import requests
+from collections import deque
+from threading import Condition, Lock
+
+# Lower runs first: a doctor or patient waiting on a reply goes ahead of
+# document extraction running in the background
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+# Provider defaults, each can be overridden with <PROVIDER>_MAX_CONCURRENCY,
+# <PROVIDER>_REQUESTS_PER_MINUTE and <PROVIDER>_INTERACTIVE_RESERVE
+PROVIDER_DEFAULTS = {
+    'gemini': {'max_concurrency': 4, 'requests_per_minute': 60, 'interactive_reserve': 0},
+    'openai': {'max_concurrency': 8, 'requests_per_minute': 300, 'interactive_reserve': 2},
+    'whisper': {'max_concurrency': 4, 'requests_per_minute': 50, 'interactive_reserve': 1},
+    'tts': {'max_concurrency': 8, 'requests_per_minute': 300, 'interactive_reserve': 2},
+}
+
+MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', 4))
+BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE_SECONDS', 0.5))
+BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', 20))
+WAIT_SAMPLES = 500
+
+# The clients are built without retries of their own, so dropped connections and
+# timeouts are retried here along with 429 and 5xx responses
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout)
+try:
+    import openai
+    RETRYABLE_ERRORS += (openai.APIConnectionError, openai.APITimeoutError)
+except ImportError:
+    pass
+
+
+def provider_limits(name: str):
+    defaults = PROVIDER_DEFAULTS[name]
+    prefix = name.upper()
+    limits = {
+        'max_concurrency': int(os.getenv(f'{prefix}_MAX_CONCURRENCY', defaults['max_concurrency'])),
+        'requests_per_minute': float(os.getenv(f'{prefix}_REQUESTS_PER_MINUTE', defaults['requests_per_minute'])),
+        'interactive_reserve': int(os.getenv(f'{prefix}_INTERACTIVE_RESERVE', defaults['interactive_reserve'])),
+    }
+    if limits['max_concurrency'] < 1:
+        raise ValueError(f"{prefix}_MAX_CONCURRENCY must be at least 1")
+    if limits['requests_per_minute'] <= 0:
+        raise ValueError(f"{prefix}_REQUESTS_PER_MINUTE must be greater than 0")
+    if limits['interactive_reserve'] < 0:
+        raise ValueError(f"{prefix}_INTERACTIVE_RESERVE must not be negative")
+    return limits
+
+
+def status_code(error):
+    # openai errors carry status_code, google.api_core errors carry code,
+    # requests.HTTPError only has it on its response
+    for attribute in ('status_code', 'code'):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    value = getattr(getattr(error, 'response', None), 'status_code', None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    code = status_code(error)
+    return code is not None and (code == 429 or code >= 500)
+
+
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int):
+    # Full jitter, so callers that failed together don't retry together
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class ProviderLimiter:
+    """Admits calls to one provider in priority order, limited by a token
+    bucket (requests per minute, bursting up to max_concurrency) and by the
+    number of calls in flight. interactive_reserve slots are kept free of
+    background work so a burst of extractions can't starve a chat."""
+
+    def __init__(self, name: str, max_concurrency: int, requests_per_minute: float, interactive_reserve: int = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(max_concurrency)
+        self.interactive_reserve = min(interactive_reserve, max_concurrency - 1)
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = Condition()
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.max_queue_depth = 0
+        self._waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _slots(self, priority):
+        if priority == INTERACTIVE:
+            return self.max_concurrency
+        return self.max_concurrency - self.interactive_reserve
+
+    def acquire(self, priority: int):
+        start_time = time.monotonic()
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+            while True:
+                self._refill()
+                if self._waiting[0] == entry and self._in_flight < self._slots(priority) and self._tokens >= 1:
+                    break
+                # Sleep until the next token when that is what's missing, otherwise until a release
+                timeout = None
+                if self._waiting[0] == entry and self._in_flight < self._slots(priority):
+                    timeout = (1 - self._tokens) / self.rate
+                self._condition.wait(timeout)
+
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._in_flight += 1
+            self._waits[priority].append(time.monotonic() - start_time)
+            # The next waiter may be admissible too
+            self._condition.notify_all()
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, retried: bool = False, failed: bool = False):
+        with self._condition:
+            self.calls += 1
+            self.retries += retried
+            self.failures += failed
+
+    def stats(self):
+        with self._condition:
+            waits = {}
+            for priority, samples in self._waits.items():
+                ordered = sorted(samples)
+                waits[PRIORITY_NAMES[priority]] = {
+                    'samples': len(ordered),
+                    'avg_seconds': sum(ordered) / len(ordered) if ordered else 0.0,
+                    'p95_seconds': ordered[int(len(ordered) * 0.95)] if ordered else 0.0,
+                    'max_seconds': ordered[-1] if ordered else 0.0
+                }
+            return {
+                'max_concurrency': self.max_concurrency,
+                'requests_per_minute': self.rate * 60,
+                'in_flight': self._in_flight,
+                'queue_depth': len(self._waiting),
+                'max_queue_depth': self.max_queue_depth,
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'wait': waits
+            }
+
+
+class HeldStream:
+    """A streamed response that keeps its provider slot until it has been
+    read to the end or closed. Closing twice is harmless."""
+
+    def __init__(self, stream, limiter: ProviderLimiter):
+        self._stream = stream
+        self._limiter = limiter
+        self._lock = Lock()
+        self._released = False
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            self._stream.close()
+        finally:
+            self._limiter.release()
+
+
+class LLMScheduler:
+    """Every outbound AI call goes through call() (or stream() for streamed
+    responses), which waits for the provider's limiter and retries 429 and
+    5xx responses with jittered exponential backoff."""
+
+    def __init__(self, providers):
+        self.providers = {name: ProviderLimiter(name, **limits) for name, limits in providers.items()}
+
+    def call(self, provider: str, fn, priority: int = BACKGROUND):
+        return self._run(provider, fn, priority, hold=False)
+
+    def stream(self, provider: str, fn, priority: int = BACKGROUND):
+        """Like call() for a function returning a stream: the slot stays taken
+        until the returned HeldStream is exhausted or closed, not only until
+        the response headers have arrived."""
+        return self._run(provider, fn, priority, hold=True)
+
+    def _run(self, provider: str, fn, priority: int, hold: bool):
+        limiter = self.providers[provider]
+        attempt = 0
+        while True:
+            limiter.acquire(priority)
+            held = False
+            try:
+                result = fn()
+                limiter.record()
+                if hold:
+                    held = True
+                    return HeldStream(result, limiter)
+                return result
+            except Exception as e:
+                attempt += 1
+                retry = is_retryable(e) and attempt < MAX_ATTEMPTS
+                limiter.record(retried=retry, failed=not retry)
+                if not retry:
+                    raise
+                delay = retry_after(e) or backoff_delay(attempt)
+                print(f"{provider} call failed with {status_code(e) or type(e).__name__}, retrying in {delay:.1f}s ({attempt}/{MAX_ATTEMPTS - 1})")
+            finally:
+                if not held:
+                    limiter.release()
+            # The slot is given back while sleeping so other callers can use it
+            time.sleep(delay)
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.providers.items()}
+
+
+llm_scheduler = LLMScheduler({name: provider_limits(name) for name in PROVIDER_DEFAULTS})
@@ -2,8 +2,19 @@ from flask import Flask, redirect, session, request, render_template_string, fla
 from healthapp.google_fit import get_flow, get_steps, get_heart_rate, get_calories, get_distance, save_fitness_data
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from image_data.gemini_api import call_gemini_api
-from voice_chat import voice_chat_bp
+from image_data.gemini_api import call_gemini_api, schema_version, extraction_stats, gemini_files
+from image_data.extraction_cache import ExtractionCache
+from image_data.staging import ImageStaging
+from image_data.normalize import normalize_images
+from image_data.pdf_writer import JpegPdfWriter
+from image_data.hedging import extraction_hedger
+from image_data.page_parallel import use_parallel_extraction, extract_in_page_groups
+from voice_chat import voice_chat_bp, tts_cache, conversations
+from audio_preprocessing import transcription_stats
+from sse import sse_event, sse_response
+from jobs import JobQueue, JOB_DONE, JOB_FAILED
+from llm_scheduler import llm_scheduler, INTERACTIVE
+from patient_data import get_patient_context, patient_context_cache, get_roster_page, get_roster_for_ids, record_document_update, list_user_ids, parse_updated_since, ROSTER_PAGE_SIZE, MAX_ROSTER_PAGE_SIZE, DOCUMENT_TYPES
 import firebase_admin
 from firebase_admin import credentials, auth, firestore, storage
 import json
@@ -16,7 +27,9 @@ from PIL import Image
 import tempfile
 import io
 import uuid
-from threading import Lock
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import wave
 from flask import make_response
@@ -52,9 +65,6 @@ def setup_logger(app):
     app.logger.setLevel(logging.INFO)
     app.logger.info('VisitEase startup')
 
-conversations = {}
-conversations_lock = Lock()
-
 app = Flask(__name__)
 # Enable CORS for both development and production
 CORS(app, supports_credentials=True, origins=[
@@ -64,7 +74,7 @@ CORS(app, supports_credentials=True, origins=[
     'https://visit-ease.vercel.app',
     'https://visit-ease-doctor.vercel.app',
     'https://visitease.onrender.com'
-])
+], expose_headers=['ETag'])
 app.secret_key = 'your_secret_key'  # Change this to a secure secret key in production
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 app.config['SESSION_COOKIE_SECURE'] = True  # Enable secure cookies for HTTPS
@@ -189,7 +199,8 @@ def signup():
             'email': email,
             'full_name': full_name,
             'date_of_birth': date_of_birth,
-            'created_at': firestore.SERVER_TIMESTAMP
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
         
         flask_user = User(user.uid, email)
@@ -391,73 +402,147 @@ def upload_image():
     
     if file and file.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
         user_id = current_user.id
+        img_data = file.read()
         bucket = storage.bucket(name='avi-cdtm-hack-team-1613.firebasestorage.app')
         blob = bucket.blob(f'users/{user_id}/image-data/{image_type}/{uuid}/{file.filename}')
-        blob.upload_from_file(file, content_type=file.content_type)
+        blob.upload_from_string(img_data, content_type=file.content_type)
+        # Keep a local copy for the conversion that usually follows right away
+        image_staging.put(user_id, image_type, uuid, file.filename, img_data)
         app.logger.info(f"Successfully uploaded image for user {user_id}: {file.filename}")
         return jsonify({'success': True, 'message': 'Image uploaded successfully'})
     
     app.logger.warning(f"Invalid image format attempted by user {current_user.email}")
     return jsonify({'success': False, 'message': 'Invalid image format'}), 400
 
-def download_images_from_firebase(user_id, image_type, usid):
-    bucket = storage.bucket(name='avi-cdtm-hack-team-1613.firebasestorage.app')
-    prefix = f'users/{user_id}/image-data/{image_type}/{usid}/'
-    blobs = list(bucket.list_blobs(prefix=prefix))
-
-    image_files = []
-    for blob in sorted(blobs, key=lambda b: b.name):
-        img_data = blob.download_as_bytes()
-        image_files.append(io.BytesIO(img_data))
+# Page downloads for all conversions share one bounded pool
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 4))
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='downloads')
 
-    return image_files
+extraction_cache = ExtractionCache(
+    os.getenv('EXTRACTION_CACHE_PATH', 'cache/extractions.sqlite3'),
+    max_bytes=int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+)
 
+image_staging = ImageStaging(
+    os.getenv('IMAGE_STAGING_DIR', os.path.join(tempfile.gettempdir(), 'visitease-staging')),
+    max_bytes=int(os.getenv('IMAGE_STAGING_MAX_BYTES', 512 * 1024 * 1024))
+)
 
-def upload_pdf_to_firebase(local_pdf_path, user_id, file_type, uuid):
+def list_image_blobs(user_id, image_type, usid):
     bucket = storage.bucket(name='avi-cdtm-hack-team-1613.firebasestorage.app')
-    blob = bucket.blob(f'users/{user_id}/pdf-data/{file_type}/{uuid}.pdf')
-    blob.upload_from_filename(local_pdf_path, content_type='application/pdf')
-    return blob.public_url
+    prefix = f'users/{user_id}/image-data/{image_type}/{usid}/'
+    return sorted(bucket.list_blobs(prefix=prefix), key=lambda b: b.name)
 
-def convert_images_to_pdf_and_upload(image_streams, user_id, image_type, uuid):
-    try:
-        # First, combine all images into a single PDF
-        images = []
-        for stream in image_streams:
-            img = Image.open(stream).convert('RGB')
-            images.append(img)
+def stream_images_from_blobs(blobs, user_id, image_type, usid):
+    def fetch_page(blob):
+        # Pages uploaded through this host are read from staging, Storage is the fallback
+        img_data = image_staging.get(user_id, image_type, usid, os.path.basename(blob.name), blob.size)
+        if img_data is None:
+            img_data = blob.download_as_bytes()
+        return img_data
+
+    # All pages are fetched concurrently but yielded in page order, each one
+    # as soon as it has arrived, so decoding starts with the first page
+    for img_data in download_executor.map(fetch_page, blobs):
+        yield io.BytesIO(img_data)
 
-        if not images:
-            raise ValueError("No images found")
+def download_images_from_firebase(user_id, image_type, usid):
+    blobs = list_image_blobs(user_id, image_type, usid)
+    return list(stream_images_from_blobs(blobs, user_id, image_type, usid))
 
-        # Create a temporary PDF with all images
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            images[0].save(tmp.name, save_all=True, append_images=images[1:])
-            tmp_path = tmp.name
 
-        print(f"Image type: {image_type}")
-        
-        # Make a single Gemini API call with the combined PDF
-        data = call_gemini_api(tmp_path, image_type)
-        
-        # Format the data based on type
-        if (image_type == "labData" or image_type == "medicationPlan"):
-            data = {image_type: data, 'created_at': firestore.SERVER_TIMESTAMP}
-        else:
-            data['created_at'] = firestore.SERVER_TIMESTAMP
-        print(f"Got the data: \n{data}")
-        db.collection('users').document(user_id).collection(image_type).document(uuid).set(data)
-
-        # Upload the combined PDF to Firebase
-        pdf_url = upload_pdf_to_firebase(tmp_path, user_id, image_type, uuid)
-        
-        # Clean up the temporary file
-        os.remove(tmp_path)
+def pdf_storage_path(user_id, file_type, uuid):
+    return f'users/{user_id}/pdf-data/{file_type}/{uuid}.pdf'
 
-        return pdf_url
-    except Exception as e:
-        print(f"Error converting/uploading PDF: {e}")
-        return None
+def upload_pdf_to_firebase(pdf, user_id, file_type, uuid):
+    # pdf is either a local path (str or os.PathLike) or the PDF itself. bytes are uploaded as they
+    # are, a bytearray or memoryview is copied into bytes once because the client only takes bytes
+    bucket = storage.bucket(name='avi-cdtm-hack-team-1613.firebasestorage.app')
+    blob = bucket.blob(pdf_storage_path(user_id, file_type, uuid))
+    if isinstance(pdf, (str, os.PathLike)):
+        blob.upload_from_filename(pdf, content_type='application/pdf')
+    else:
+        blob.upload_from_string(pdf if isinstance(pdf, bytes) else bytes(pdf), content_type='application/pdf')
+    return blob.public_url
+
+def convert_images_to_pdf_and_upload(image_streams, user_id, image_type, uuid, on_stage=None):
+    def set_stage(stage):
+        if on_stage:
+            on_stage(stage)
+
+    set_stage('converting')
+    # Normalize the photos (orientation, size, JPEG quality) and write them
+    # into a single PDF one page at a time, embedding the JPEGs as they are
+    original_bytes = 0
+    normalized_bytes = 0
+    page_hash = hashlib.sha256()
+    pdf_buffer = io.BytesIO()
+    with JpegPdfWriter(pdf_buffer) as pdf:
+        for normalized, original_size in normalize_images(image_streams):
+            pdf.add_page(normalized)
+            page_hash.update(len(normalized).to_bytes(8, 'big'))
+            page_hash.update(normalized)
+            original_bytes += original_size
+            normalized_bytes += len(normalized)
+
+    # The PDF only lives in memory, Gemini and the upload share this one copy
+    pdf_bytes = pdf_buffer.getvalue()
+    pdf_buffer.close()
+    page_count = len(pdf.page_spans)
+    print(f"Normalized {page_count} page(s): {original_bytes / 1e6:.2f} MB -> {normalized_bytes / 1e6:.2f} MB")
+
+    print(f"Image type: {image_type}")
+    
+    # Make a single Gemini API call with the combined PDF, or one per page group for
+    # long documents, unless the same pages were extracted before
+    set_stage('extracting')
+    file_path = pdf_storage_path(user_id, image_type, uuid)
+    if use_parallel_extraction(image_type, page_count):
+        # The pages are views into the PDF, its embedded JPEGs are the normalized pages unchanged
+        pages = [memoryview(pdf_bytes)[start:end] for start, end in pdf.page_spans]
+        extract = lambda: extract_in_page_groups(pages, image_type, file_path)
+    else:
+        extract = lambda: call_gemini_api(pdf_bytes, image_type, file_path=file_path)
+    data = extraction_cache.get_or_extract(page_hash.hexdigest(), image_type, schema_version(image_type), file_path, extract)
+    
+    # Format the data based on type
+    if (image_type == "labData" or image_type == "medicationPlan"):
+        data = {image_type: data, 'created_at': firestore.SERVER_TIMESTAMP}
+    else:
+        data['created_at'] = firestore.SERVER_TIMESTAMP
+    print(f"Got the data: \n{data}")
+    set_stage('saving')
+    db.collection('users').document(user_id).collection(image_type).document(uuid).set(data)
+    record_document_update(user_id, image_type, data)
+
+    # Upload the combined PDF to Firebase
+    set_stage('uploading')
+    pdf_url = upload_pdf_to_firebase(pdf_bytes, user_id, image_type, uuid)
+
+    return pdf_url
+
+def run_conversion_job(job, set_stage):
+    set_stage('downloading')
+    blobs = list_image_blobs(job['user_id'], job['image_type'], job['uuid'])
+    if not blobs:
+        raise ValueError('No images found in Firebase')
+    image_streams = stream_images_from_blobs(blobs, job['user_id'], job['image_type'], job['uuid'])
+
+    # Errors propagate so the job records the Gemini, Firestore or Storage error itself
+    pdf_url = convert_images_to_pdf_and_upload(image_streams, job['user_id'], job['image_type'], job['uuid'], on_stage=set_stage)
+    image_staging.discard(job['user_id'], job['image_type'], job['uuid'])
+
+    app.logger.info(f"Successfully converted images to PDF for user {job['user_id']}")
+    return pdf_url
+
+# The conversion pipeline runs here instead of in the request worker
+conversion_jobs = JobQueue(
+    os.getenv('JOBS_DB_PATH', 'jobs/jobs.sqlite3'),
+    run_conversion_job,
+    max_workers=int(os.getenv('CONVERSION_WORKERS', 4))
+)
+MAX_BATCH_DOCUMENTS = int(os.getenv('MAX_BATCH_DOCUMENTS', 8))
+conversion_jobs.start_reaper()
 
 @app.route('/convert-images-to-pdf', methods=['POST'])
 @login_required
@@ -470,50 +555,94 @@ def convert_images_to_pdf():
         app.logger.warning(f"Missing required fields for user {current_user.email}")
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
 
-    user_id = current_user.id
-    
     try:
-        # Download all images for this upload
-        image_streams = download_images_from_firebase(user_id, image_type, uuid)
-        if not image_streams:
-            app.logger.warning(f"No images found for user {user_id}")
-            return jsonify({'success': False, 'message': 'No images found in Firebase'}), 404
-
-        # Process all images at once
-        pdf_url = convert_images_to_pdf_and_upload(image_streams, user_id, image_type, uuid)
-        
-        if pdf_url:
-            app.logger.info(f"Successfully converted images to PDF for user {user_id}")
-            return jsonify({'success': True, 'pdf_url': pdf_url})
-        else:
-            app.logger.error(f"PDF generation failed for user {user_id}")
-            return jsonify({'success': False, 'message': 'PDF generation failed'}), 500
+        job_id = conversion_jobs.submit(current_user.id, image_type, uuid)
+        app.logger.info(f"Queued PDF conversion job {job_id} for user {current_user.id}")
+        return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('get_job', job_id=job_id)}), 202
     except Exception as e:
         app.logger.error(f"Error in convert_images_to_pdf: {str(e)}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/convert-images-to-pdf/batch', methods=['POST'])
+@login_required
+def convert_images_to_pdf_batch():
+    app.logger.info(f"Batch PDF conversion attempt for user: {current_user.email}")
+    documents = (request.get_json(silent=True) or {}).get('documents')
 
-@app.route('/get-structured-data', methods=["GET"])
-def get_structured_data():
-    user_id = request.args.get('user_id')
-    return model_user_data(user_id)
+    if not documents or not isinstance(documents, list):
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    if len(documents) > MAX_BATCH_DOCUMENTS:
+        return jsonify({'success': False, 'message': f'At most {MAX_BATCH_DOCUMENTS} documents per batch'}), 400
+    if not all(isinstance(document, dict) and document.get('image_type') in DOCUMENT_TYPES and document.get('uuid') for document in documents):
+        return jsonify({'success': False, 'message': 'Every document needs a valid image_type and uuid'}), 400
 
-def model_user_data(uuid: str):
+    try:
+        batch_id = conversion_jobs.submit_batch(current_user.id, [(document['image_type'], document['uuid']) for document in documents])
+        app.logger.info(f"Queued PDF conversion batch {batch_id} with {len(documents)} document(s) for user {current_user.id}")
+        return jsonify({'success': True, 'batch_id': batch_id, 'status_url': url_for('get_batch', batch_id=batch_id)}), 202
+    except Exception as e:
+        app.logger.error(f"Error in convert_images_to_pdf_batch: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-    user_ref = db.collection('users').document(uuid)
+def job_status(job):
+    return {
+        'success': job['status'] != JOB_FAILED,
+        'job_id': job['id'],
+        'image_type': job['image_type'],
+        'uuid': job['uuid'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'done': job['status'] in (JOB_DONE, JOB_FAILED),
+        'pdf_url': job['pdf_url'],
+        'message': job['error']
+    }
 
-    sub_collections = user_ref.collections()
+@app.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job = conversion_jobs.get(job_id)
+    if not job or job['user_id'] != current_user.id:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
 
-    user_model_dict = defaultdict()
+    return jsonify(job_status(job))
 
-    for collection in sub_collections:
-        docs = collection.order_by(field_path="created_at", direction=firestore.Query.DESCENDING).limit(1)
-        for doc in docs.stream():
-            doc_dict = doc.to_dict()
-            doc_dict['created_at'] = datetime.datetime.fromtimestamp(doc_dict['created_at'].timestamp()).strftime('%d-%m-%Y')
-            user_model_dict[collection.id] = doc_dict
+@app.route('/batches/<batch_id>', methods=['GET'])
+@login_required
+def get_batch(batch_id):
+    jobs = conversion_jobs.get_batch(batch_id)
+    if not jobs or jobs[0]['user_id'] != current_user.id:
+        return jsonify({'success': False, 'message': 'Batch not found'}), 404
+
+    # Documents are listed as they complete, the client can show each result right away
+    documents = [job_status(job) for job in jobs]
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'done': all(document['done'] for document in documents),
+        'completed': sum(document['done'] for document in documents),
+        'total': len(documents),
+        'documents': documents
+    })
 
-    return user_model_dict
+
+@app.route('/get-structured-data', methods=["GET"])
+def get_structured_data():
+    user_id = request.args.get('user_id')
+    return get_patient_context(user_id)
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    return jsonify({
+        'patient_context_cache': patient_context_cache.stats(),
+        'extraction_cache': extraction_cache.stats(),
+        'extraction_parsing': extraction_stats.stats(),
+        'extraction_hedging': extraction_hedger.stats(),
+        'gemini_files': gemini_files.stats(),
+        'tts_cache': tts_cache.stats(),
+        'transcription': transcription_stats.stats(),
+        'conversations': conversations.stats(),
+        'llm_scheduler': llm_scheduler.stats()
+    })
 
 @app.route('/get-pdf-by-type-for-user', methods=["GET"])
 def get_user_type_pdf():
@@ -548,8 +677,50 @@ def get_user_type_pdf():
 
 @app.route('/get-user-ids', methods=["GET"])
 def get_user_ids():
-    user_docs = db.collection('users').stream()
-    return [doc.id for doc in user_docs]
+    limit = request.args.get('limit', type=int)
+    start_after = request.args.get('start_after')
+    updated_since = request.args.get('updated_since')
+
+    # Without paging parameters keep returning the plain list of all IDs
+    if limit is None and not start_after and not updated_since:
+        user_docs = db.collection('users').select([]).stream()
+        return [doc.id for doc in user_docs]
+
+    try:
+        if updated_since:
+            updated_since = parse_updated_since(updated_since)
+    except ValueError:
+        return jsonify({'error': 'Invalid updated_since, expected ISO 8601'}), 400
+
+    try:
+        # With updated_since, next_cursor is opaque and only valid for the same kind of request
+        user_ids, next_cursor = list_user_ids(limit or ROSTER_PAGE_SIZE, start_after, updated_since or None)
+        return jsonify({'user_ids': user_ids, 'next_cursor': next_cursor})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Error in get_user_ids: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/get-patient-roster', methods=["GET"])
+def get_patient_roster():
+    user_ids = request.args.get('user_ids')
+
+    try:
+        if user_ids:
+            user_ids = [user_id for user_id in user_ids.split(',') if user_id]
+            if len(user_ids) > MAX_ROSTER_PAGE_SIZE:
+                return jsonify({'error': f'At most {MAX_ROSTER_PAGE_SIZE} user_ids per request'}), 400
+            patients = get_roster_for_ids(user_ids)
+            return jsonify({'patients': patients, 'next_cursor': None})
+
+        limit = request.args.get('limit', ROSTER_PAGE_SIZE, type=int)
+        start_after = request.args.get('start_after')
+        patients, next_cursor = get_roster_page(limit, start_after)
+        return jsonify({'patients': patients, 'next_cursor': next_cursor})
+    except Exception as e:
+        app.logger.error(f"Error in get_patient_roster: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/get-user-basic-profile', methods=["GET"])
 def get_user_basic_profile():
@@ -574,6 +745,31 @@ def get_user_basic_profile():
         })
 
 # --- DOCTOR CHAT ENDPOINT ---
+DOCTOR_SYSTEM_PROMPT = {"role": "system", "content": "You are GPT-4o, a highly specialized clinical‐decision support assistant, directly integrated into the workflow of a board-certified physician. Your purpose is to help the doctor work faster, safer, and more confidently.\nKnowledge & Evidence\nAlways draw on the latest peer-reviewed literature, clinical guidelines (e.g. ACCF/AHA, NICE, WHO, UpToDate), and standard textbooks.\nWhen you state data (e.g. sensitivities, drug dosages, study outcomes), cite your source and year (e.g. \"per 2024 ACC/AHA Guideline\").\nIf you're uncertain or the question lies outside established guidelines, ask a clarifying question or suggest consulting a subspecialist.\nTone & Style\nUse concise, precise language and standard medical terminology.\nWhen communicating patient-facing language or lay explanations, translate jargon into clear, empathic phrasing.\nMaintain professional neutrality—avoid jargon overload, value‐judgments, or sensationalism.\nWorkflow Integration\nSummarize key findings in bullet points or tables (e.g. differential diagnoses, drug dosing, management algorithms).\nFlag \"high–priority\" safety concerns (e.g. drug interactions, red-flag symptoms) at the top of your response.\nWhen requested, generate templated notes (SOAP, H&P, discharge summaries) that adhere to common EHR formatting.\nInteraction Guidelines\nIf the doctor's query is ambiguous, ask one focused clarifying question rather than guessing.\nOffer to drill down into epidemiology, pathophysiology, diagnostics, therapeutics, or patient education as needed.\nBe ready to generate visual aids (charts, algorithm diagrams) on request, formatted for quick review.\nYou exist to make each clinical encounter safer, more efficient, and more evidence‐based—think like an attending physician's most trusted senior resident. Keep the responses short and concise. Only output text and not any weird formatting."}
+
+def doctor_chat_messages(data, user_context):
+    # Always prepend a system prompt
+    system_prompt = DOCTOR_SYSTEM_PROMPT
+
+    # If frontend sends a full messages array, use it (prepend context as system message)
+    if 'messages' in data:
+        messages = data['messages']
+        # Prepend a system message with patient context if not already present
+        if not messages or messages[0].get('role') != 'system' or messages[0].get('content') != system_prompt['content']:
+            messages = [system_prompt, {"role": "system", "content": f"Patient context: {json.dumps(user_context, ensure_ascii=False)}"}] + messages
+        elif len(messages) == 1 or messages[1].get('role') != 'system' or not messages[1].get('content', '').startswith('Patient context:'):
+            messages = [messages[0], {"role": "system", "content": f"Patient context: {json.dumps(user_context, ensure_ascii=False)}"}] + messages[1:]
+        return messages
+
+    # Otherwise, build a single-turn message
+    if 'message' not in data:
+        return None
+    return [
+        system_prompt,
+        {"role": "system", "content": f"Patient context: {json.dumps(user_context, ensure_ascii=False)}"},
+        {"role": "user", "content": data['message']}
+    ]
+
 @app.route('/api/doctor-chat', methods=['POST'])
 def doctor_chat():
     try:
@@ -585,37 +781,19 @@ def doctor_chat():
         if not data or 'user_id' not in data:
             return jsonify({'error': 'Missing user_id'}), 400
         user_id = data['user_id']
-        user_context = model_user_data(user_id)
-
-        # Always prepend a system prompt
-        system_prompt = {"role": "system", "content": "You are GPT-4o, a highly specialized clinical‐decision support assistant, directly integrated into the workflow of a board-certified physician. Your purpose is to help the doctor work faster, safer, and more confidently.\nKnowledge & Evidence\nAlways draw on the latest peer-reviewed literature, clinical guidelines (e.g. ACCF/AHA, NICE, WHO, UpToDate), and standard textbooks.\nWhen you state data (e.g. sensitivities, drug dosages, study outcomes), cite your source and year (e.g. \"per 2024 ACC/AHA Guideline\").\nIf you're uncertain or the question lies outside established guidelines, ask a clarifying question or suggest consulting a subspecialist.\nTone & Style\nUse concise, precise language and standard medical terminology.\nWhen communicating patient-facing language or lay explanations, translate jargon into clear, empathic phrasing.\nMaintain professional neutrality—avoid jargon overload, value‐judgments, or sensationalism.\nWorkflow Integration\nSummarize key findings in bullet points or tables (e.g. differential diagnoses, drug dosing, management algorithms).\nFlag \"high–priority\" safety concerns (e.g. drug interactions, red-flag symptoms) at the top of your response.\nWhen requested, generate templated notes (SOAP, H&P, discharge summaries) that adhere to common EHR formatting.\nInteraction Guidelines\nIf the doctor's query is ambiguous, ask one focused clarifying question rather than guessing.\nOffer to drill down into epidemiology, pathophysiology, diagnostics, therapeutics, or patient education as needed.\nBe ready to generate visual aids (charts, algorithm diagrams) on request, formatted for quick review.\nYou exist to make each clinical encounter safer, more efficient, and more evidence‐based—think like an attending physician's most trusted senior resident. Keep the responses short and concise. Only output text and not any weird formatting."}
-
-        # If frontend sends a full messages array, use it (prepend context as system message)
-        if 'messages' in data:
-            messages = data['messages']
-            # Prepend a system message with patient context if not already present
-            if not messages or messages[0].get('role') != 'system' or messages[0].get('content') != system_prompt['content']:
-                messages = [system_prompt, {"role": "system", "content": f"Patient context: {json.dumps(user_context, ensure_ascii=False)}"}] + messages
-            elif len(messages) == 1 or messages[1].get('role') != 'system' or not messages[1].get('content', '').startswith('Patient context:'):
-                messages = [messages[0], {"role": "system", "content": f"Patient context: {json.dumps(user_context, ensure_ascii=False)}"}] + messages[1:]
-        else:
-            # Otherwise, build a single-turn message
-            if 'message' not in data:
-                return jsonify({'error': 'Missing message'}), 400
-            message = data['message']
-            messages = [
-                system_prompt,
-                {"role": "system", "content": f"Patient context: {json.dumps(user_context, ensure_ascii=False)}"},
-                {"role": "user", "content": message}
-            ]
-
-        import openai
-        client = openai.OpenAI(api_key=api_key)
+        user_context = get_patient_context(user_id)
+
+        messages = doctor_chat_messages(data, user_context)
+        if messages is None:
+            return jsonify({'error': 'Missing message'}), 400
+
+        # Retries are left to the scheduler
+        client = openai.OpenAI(api_key=api_key, max_retries=0)
         try:
-            response = client.chat.completions.create(
+            response = llm_scheduler.call('openai', lambda: client.chat.completions.create(
                 model="gpt-4o",
                 messages=messages
-            )
+            ), INTERACTIVE)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
         return jsonify({'response': response.choices[0].message.content})
@@ -623,5 +801,64 @@ def doctor_chat():
         print(f"Error in doctor_chat endpoint: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/doctor-chat/stream', methods=['POST'])
+def doctor_chat_stream():
+    # Same request body as /api/doctor-chat, the reply is sent as Server-Sent Events:
+    # one "data: {delta}" event per token chunk, then a "done" (or "error") event
+    load_dotenv()
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return jsonify({'error': 'OpenAI API key not set'}), 500
+    data = request.get_json()
+    if not data or 'user_id' not in data:
+        return jsonify({'error': 'Missing user_id'}), 400
+    user_id = data['user_id']
+
+    try:
+        messages = doctor_chat_messages(data, get_patient_context(user_id))
+        if messages is None:
+            return jsonify({'error': 'Missing message'}), 400
+
+        client = openai.OpenAI(api_key=api_key, max_retries=0)
+        start_time = time.perf_counter()
+        # The scheduler slot is held until the stream is closed in generate()
+        stream = llm_scheduler.stream('openai', lambda: client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            stream=True
+        ), INTERACTIVE)
+    except Exception as e:
+        print(f"Error in doctor_chat_stream endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    def generate():
+        first_token_time = None
+        # Stays 'cancelled' when the client disconnects and the generator is closed mid-stream
+        status = 'cancelled'
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                yield sse_event({'delta': delta})
+            status = 'completed'
+            yield sse_event({}, event='done')
+        except Exception as e:
+            print(f"Error while streaming doctor chat: {str(e)}")
+            status = 'failed'
+            yield sse_event({'error': str(e)}, event='error')
+        finally:
+            # Runs on GeneratorExit too, when the doctor closes the chat the upstream request is dropped
+            # and the scheduler slot given back
+            stream.close()
+            ttft = f"{first_token_time:.2f}s" if first_token_time is not None else "n/a"
+            app.logger.info(
+                f"doctor-chat stream for {user_id} {status}: first token {ttft}, total {time.perf_counter() - start_time:.2f}s"
+            )
+
+    return sse_response(generate(), on_close=stream.close)
+
 if __name__ == '__main__':
     app.run(port=8080, debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,183 @@
+import os
+import copy
+import json
+import base64
+import datetime
+from firebase_admin import firestore
+from firebase_config import db
+from caching import TTLCache
+from user_model import model_user_data as _model_user_data, format_timestamp
+
+# Document types produced by the onboarding extraction pipeline
+DOCUMENT_TYPES = ['insuranceCard', 'labData', 'doctorLetter', 'medicationPlan']
+
+# Only these fields of a user document are needed to render a roster row
+ROSTER_FIELDS = ['full_name', 'date_of_birth', 'email', 'created_at', 'roster']
+
+ROSTER_PAGE_SIZE = int(os.getenv('ROSTER_PAGE_SIZE', 50))
+# Also the most IDs /get-patient-roster?user_ids=... takes in one request
+MAX_ROSTER_PAGE_SIZE = 200
+MAX_USER_ID_PAGE_SIZE = 1000
+
+# Patient context only changes when an extraction or fitness write happens,
+# those paths invalidate it. The TTL bounds staleness across worker processes.
+patient_context_cache = TTLCache(
+    maxsize=int(os.getenv('PATIENT_CONTEXT_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('PATIENT_CONTEXT_CACHE_TTL', 300))
+)
+
+
+def model_user_data(uuid: str, client=None):
+    return _model_user_data(uuid, client or db)
+
+
+def get_patient_context(user_id):
+    # Callers get their own copy so they can't modify the cached context
+    context = patient_context_cache.get_or_load(user_id, lambda: model_user_data(user_id))
+    return copy.deepcopy(context)
+
+
+def invalidate_patient_context(user_id):
+    patient_context_cache.invalidate(user_id)
+
+
+def record_document_update(user_id, image_type, data):
+    # Denormalize what the doctor roster needs onto the user document so a
+    # roster page never has to scan the per-type subcollections
+    summary = {'last_updated': {image_type: firestore.SERVER_TIMESTAMP}}
+    if image_type == 'insuranceCard':
+        summary['insurance_name'] = data.get('name', '')
+        summary['insurance_provider'] = data.get('insuranceProvider', '')
+        summary['insurance_birth_date'] = data.get('birthDate', '')
+        summary['insurance_gender'] = data.get('gender', '')
+
+    db.collection('users').document(user_id).set({
+        'roster': summary,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }, merge=True)
+    invalidate_patient_context(user_id)
+
+
+def build_roster_summary(user_id):
+    # Backfill for users whose documents were extracted before the roster
+    # summary existed, run once for all of them by backfill_users.py
+    user_ref = db.collection('users').document(user_id)
+    summary = {'last_updated': {}}
+
+    for image_type in DOCUMENT_TYPES:
+        docs = user_ref.collection(image_type).order_by(field_path="created_at", direction=firestore.Query.DESCENDING).limit(1)
+        for doc in docs.stream():
+            doc_dict = doc.to_dict()
+            summary['last_updated'][image_type] = doc_dict['created_at']
+            if image_type == 'insuranceCard':
+                summary['insurance_name'] = doc_dict.get('name', '')
+                summary['insurance_provider'] = doc_dict.get('insuranceProvider', '')
+                summary['insurance_birth_date'] = doc_dict.get('birthDate', '')
+                summary['insurance_gender'] = doc_dict.get('gender', '')
+
+    user_ref.set({'roster': summary}, merge=True)
+    return summary
+
+
+def summarize_patient(user_id, user_dict):
+    # Users without a stored summary (not backfilled yet) are listed from their profile alone,
+    # building it here would cost four subcollection queries per row
+    roster = user_dict.get('roster') or {}
+
+    return {
+        'user_id': user_id,
+        'full_name': roster.get('insurance_name') or user_dict.get('full_name') or 'Unknown Patient',
+        'date_of_birth': roster.get('insurance_birth_date') or user_dict.get('date_of_birth', ''),
+        'insurance_provider': roster.get('insurance_provider', ''),
+        'gender': roster.get('insurance_gender', ''),
+        'email': user_dict.get('email', ''),
+        'created_at': str(user_dict.get('created_at', '')),
+        'last_updated': {
+            image_type: format_timestamp(timestamp)
+            for image_type, timestamp in roster.get('last_updated', {}).items()
+            if timestamp is not None
+        },
+        'incomplete': not roster.get('insurance_name')
+    }
+
+
+def get_roster_page(limit=ROSTER_PAGE_SIZE, start_after=None):
+    limit = max(1, min(limit, MAX_ROSTER_PAGE_SIZE))
+    document_id = firestore.FieldPath.document_id()
+
+    query = db.collection('users').select(ROSTER_FIELDS).order_by(document_id).limit(limit)
+    if start_after:
+        query = query.start_after({document_id: db.collection('users').document(start_after)})
+
+    patients = [summarize_patient(doc.id, doc.to_dict() or {}) for doc in query.stream()]
+    next_cursor = patients[-1]['user_id'] if len(patients) == limit else None
+    return patients, next_cursor
+
+
+def get_roster_for_ids(user_ids):
+    # One batched read for an explicit set of patients, e.g. the IDs a doctor
+    # client got back from an incremental /get-user-ids sync
+    refs = [db.collection('users').document(user_id) for user_id in user_ids]
+    snapshots = {snapshot.id: snapshot for snapshot in db.get_all(refs, field_paths=ROSTER_FIELDS)}
+
+    patients = []
+    for user_id in user_ids:
+        snapshot = snapshots.get(user_id)
+        if snapshot is None or not snapshot.exists:
+            continue
+        patients.append(summarize_patient(user_id, snapshot.to_dict() or {}))
+    return patients
+
+
+def parse_updated_since(value):
+    # ISO 8601, naive values are taken as UTC
+    updated_since = datetime.datetime.fromisoformat(value)
+    if updated_since.tzinfo is None:
+        updated_since = updated_since.replace(tzinfo=datetime.timezone.utc)
+    return updated_since
+
+
+def encode_sync_cursor(updated_at, user_id):
+    payload = json.dumps([updated_at.isoformat(), user_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_sync_cursor(cursor):
+    # Raises ValueError for anything that is not a cursor this module handed out
+    try:
+        updated_at, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(updated_at), user_id
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def list_user_ids(limit, start_after=None, updated_since=None):
+    # select() projects the documents down to their keys (plus updated_at for
+    # the sync cursor), so no user data travels over the wire just to list IDs.
+    # Users are only matched by updated_since once they have an updated_at,
+    # older accounts get one from backfill_users.py.
+    limit = max(1, min(limit, MAX_USER_ID_PAGE_SIZE))
+    users = db.collection('users')
+    document_id = firestore.FieldPath.document_id()
+
+    if updated_since is not None:
+        query = users.select(['updated_at']).where('updated_at', '>=', updated_since).order_by('updated_at').order_by(document_id)
+        if start_after:
+            # The cursor carries the updated_at the last user had when the page was read, so a
+            # later update of that user (or its deletion) doesn't move the page boundary
+            updated_at, user_id = decode_sync_cursor(start_after)
+            query = query.start_after({'updated_at': updated_at, document_id: users.document(user_id)})
+
+        docs = list(query.limit(limit).stream())
+        next_cursor = None
+        if len(docs) == limit:
+            next_cursor = encode_sync_cursor(docs[-1].to_dict()['updated_at'], docs[-1].id)
+        return [doc.id for doc in docs], next_cursor
+
+    query = users.select([]).order_by(document_id)
+    if start_after:
+        query = query.start_after({document_id: users.document(start_after)})
+
+    user_ids = [doc.id for doc in query.limit(limit).stream()]
+    next_cursor = user_ids[-1] if len(user_ids) == limit else None
+    return user_ids, next_cursor
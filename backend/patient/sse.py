@@ -0,0 +1,18 @@
+import json
+from flask import Response
+
+
+def sse_event(payload, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def sse_response(events, on_close=None):
+    response = Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # A generator that never started skips its finally block, on_close covers a client gone before the first event
+    if on_close:
+        response.call_on_close(on_close)
+    return response
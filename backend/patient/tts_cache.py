@@ -0,0 +1,141 @@
+import os
+import json
+import uuid
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from caching import TTLCache
+
+
+class TTSCache:
+    """Synthesized audio keyed by everything that affects it: the text, the
+    voice, the speaking rate and the pitch. Recently used clips are kept in
+    memory. Only phrases that persist_after different users have asked for
+    (greetings, the closing sentence) are also kept on disk, until the
+    directory grows past max_bytes, least recently used first. Replies
+    specific to one patient never reach the disk."""
+
+    def __init__(self, root: str, max_bytes: int, memory_entries: int, memory_ttl: float, persist_after: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.persist_after = persist_after
+        self.memory = TTLCache(memory_entries, memory_ttl)
+        # Hashed IDs of the users who asked for a clip, never the text itself
+        self._requesters = TTLCache(memory_entries * 8, memory_ttl)
+        self._lock = Lock()
+        self.disk_hits = 0
+        self.disk_writes = 0
+        self.syntheses = 0
+        os.makedirs(root, exist_ok=True)
+
+        # Clip sizes on disk in least recently used order, kept up to date on every read and write
+        self._clips = OrderedDict()
+        self._bytes = 0
+        clips = []
+        for entry in os.scandir(root):
+            if entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                clips.append((stat.st_mtime, entry.name[:-len('.mp3')], stat.st_size))
+        for _, key, size in sorted(clips):
+            self._clips[key] = size
+            self._bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(text: str, voice: str, speaking_rate: float, pitch: float):
+        return hashlib.sha256(json.dumps([text, voice, speaking_rate, pitch], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, f'{key}.mp3')
+
+    def _read(self, key):
+        with self._lock:
+            if key not in self._clips:
+                return None
+            self._clips.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time orders the clips again after a restart
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._bytes -= self._clips.pop(key, 0)
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        return data
+
+    def _write(self, key, data: bytes):
+        # Write then rename so a concurrent reader never sees a partial clip
+        tmp_path = os.path.join(self.root, f'.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._bytes += len(data) - self._clips.pop(key, 0)
+            self._clips[key] = len(data)
+            self.disk_writes += 1
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._clips:
+            key, size = self._clips.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _shared(self, key, user_id):
+        # Whether enough different users asked for this clip that it is not specific to any of them
+        if user_id is None:
+            return False
+        requester = hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            requesters = self._requesters.get(key) or frozenset()
+            if requester not in requesters:
+                requesters = requesters | {requester}
+                self._requesters.set(key, requesters)
+        return len(requesters) >= self.persist_after
+
+    def get(self, key):
+        # Cached audio only, for lookups by key where the text is not known
+        data = self.memory.get(key)
+        if data is None:
+            data = self._read(key)
+            if data is not None:
+                self.memory.set(key, data)
+        return data
+
+    def get_or_synthesize(self, key, synthesize, user_id=None):
+        shared = self._shared(key, user_id)
+        data = self.memory.get(key)
+        if data is None:
+            data = self._read(key)
+        if data is None:
+            data = synthesize()
+            with self._lock:
+                self.syntheses += 1
+        self.memory.set(key, data)
+
+        if shared:
+            with self._lock:
+                on_disk = key in self._clips
+            if not on_disk:
+                self._write(key, data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                'memory': self.memory.stats(),
+                'disk_clips': len(self._clips),
+                'disk_bytes': self._bytes,
+                'disk_hits': self.disk_hits,
+                'disk_writes': self.disk_writes,
+                'syntheses': self.syntheses,
+                'max_bytes': self.max_bytes,
+                'persist_after': self.persist_after
+            }
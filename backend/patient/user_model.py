@@ -0,0 +1,43 @@
+# Builds the patient model from the latest document of every subcollection.
+# Takes the Firestore client as an argument and does not import Firebase, so
+# the benchmarks can run it against an in-memory stand-in.
+import os
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded pool for the per-subcollection "latest document" queries
+SUBCOLLECTION_WORKERS = int(os.getenv('SUBCOLLECTION_WORKERS', 8))
+_subcollection_executor = ThreadPoolExecutor(max_workers=SUBCOLLECTION_WORKERS, thread_name_prefix='subcollections')
+
+# Same value as firestore.Query.DESCENDING
+DESCENDING = 'DESCENDING'
+
+
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp.timestamp()).strftime('%d-%m-%Y')
+
+
+def _latest_document(collection):
+    docs = collection.order_by(field_path="created_at", direction=DESCENDING).limit(1)
+    for doc in docs.stream():
+        doc_dict = doc.to_dict()
+        doc_dict['created_at'] = format_timestamp(doc_dict['created_at'])
+        return doc_dict
+    return None
+
+
+def model_user_data(uuid: str, client):
+    user_ref = client.collection('users').document(uuid)
+
+    sub_collections = list(user_ref.collections())
+
+    user_model_dict = defaultdict()
+
+    # The queries run concurrently, results are collected in collection order
+    latest_docs = _subcollection_executor.map(_latest_document, sub_collections)
+    for collection, doc_dict in zip(sub_collections, latest_docs):
+        if doc_dict is not None:
+            user_model_dict[collection.id] = doc_dict
+
+    return user_model_dict
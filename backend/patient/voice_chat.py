@@ -1,17 +1,28 @@
-from collections import defaultdict
-from flask import Blueprint, request, jsonify, send_file, session
+from collections import defaultdict, deque
+from flask import Blueprint, request, jsonify, session, Response
 import openai
 import os
 import json
 import datetime
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
-import tempfile
 from google.cloud import texttospeech
 from google.oauth2 import service_account
 import firebase_admin
 from firebase_admin import firestore, credentials
 import io
+import re
+import time
+import base64
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from patient_data import get_patient_context
+from llm_scheduler import llm_scheduler, INTERACTIVE, BACKGROUND
+from tts_cache import TTSCache
+from conversation_store import ConversationStore
+from sse import sse_event, sse_response
+from audio_sessions import audio_sessions, SAMPLE_RATE
+from audio_preprocessing import prepare_for_transcription, transcription_stats
 
 # Load environment variables
 load_dotenv()
@@ -46,7 +57,8 @@ if not api_key:
     raise ValueError("OPENAI_API_KEY environment variable is not set. Please create a .env file with your OpenAI API key.")
 
 # Initialize OpenAI client
-client = openai.OpenAI(api_key=api_key)
+# Retries are left to the scheduler
+client = openai.OpenAI(api_key=api_key, max_retries=0)
 
 # Initialize Google Cloud TTS client with credentials from environment
 google_cloud_credentials = {
@@ -307,22 +319,85 @@ SCHEMA_INSURANCE_CARD = {
     }
 }
 
-def model_user_data(uuid: str):
-
-    user_ref = db.collection('users').document(uuid)
-
-    sub_collections = user_ref.collections()
-
-    user_model_dict = defaultdict()
-
-    for collection in sub_collections:
-        docs = collection.order_by(field_path="created_at", direction=firestore.Query.DESCENDING).limit(1)
-        for doc in docs.stream():
-            doc_dict = doc.to_dict()
-            doc_dict['created_at'] = datetime.datetime.fromtimestamp(doc_dict['created_at'].timestamp()).strftime('%d-%m-%Y')
-            user_model_dict[collection.id] = doc_dict
-
-    return user_model_dict
+def chat_messages(message, user_model_dict, summary='', history=()):
+    # Enhanced system prompt for medical data collection
+    system_prompt = f"""You are an empathetic healthcare professional who is supposed to have a short conversation with a patient who potentially already shared some relevant patient data like recent lab results, doctor's letters, their insurance card information and a medication plan. Your goal is to use the context provided in a single dictionary to derive natural language questions that can bring valuable insight into the state and well-being of the patient for a doctor but also not overwhelm the user in their complexity and length. Make sure to use relatively simple language and be empathetic.
+
+    The following schemas detail how the inputs of the user might be structured for each type of input. These inputs are possible:
+    * insuranceCard (Insurance Card Data)
+    * doctorLetter (The most recent Doctor Letter (Arztbrief))
+    * labData (The most recent data gathered from a laboratory analysis)
+    * medicationPlan (A medication plan detailing what medication to take at which times)
+    The Schema are defined as follows
+    insuranceCard:
+    {SCHEMA_INSURANCE_CARD}
+    doctorLetter:
+    {SCHEMA_DOCTOR_LETTER}
+    labData:
+    {SCHEMA_LAB_DATA}
+    medicationPlan:
+    {SCHEMA_MEDICATION_PLAN}
+    You will receive the contextual user data in a dictionary that uses the previously defined inputs as keys (i.e. 'insuranceCard', 'doctorLetter', 'labData', 'medicationPlan') and the corresponding dictionary (defined by the SCHEMA) as the value.
+    Your task is to lead a natural conversation and ask a maximum of 5 questions to find out how the patient feels. Your goal is to find out what the doctors can't describe in their letters and lab analysis - the patients feelings and emotions. 
+    If you notice that the patient wants to end the conversation specifically ask him if he wants to end the conversation. Usually you can assume that they want to continue but if you notice the patient getting aggravated feel free to ask them to stop right there. You can also just end the conversation early by saying these are all the questions I wanted to ask today, thank you for your time. That way the user doesn't even realize that you just purposefully ended the conversation in order to avoid confrontation.
+    For undefined behavior, i.e. queries or answers that have nothing to do with the medical history of the patient and are in general not related to the healthcare of the patient at all are not to be answered. You can just respond with the standard reponse of: "At this time I'm not able to make a comment about this specific topic, let's continue talking about your health".
+    Do not try to match the users style of speaking (i.e. slang, millenial...) as this might irritate them. The following dictonary is the described user context:
+    {json.dumps(user_model_dict, indent=4, ensure_ascii=False)}"""
+    
+    # Special handling for initial message
+    if message == 'start':
+        initial_prompt = f"""Based on the patient's data, start the conversation with a specific question about their health. DO NOT use generic greetings or ask how you can help. Instead, immediately ask about something specific from their medical data. For example:
+        - If they have lab results, ask about how they're feeling regarding those specific results
+        - If they have a medication plan, ask about their experience with the medications
+        - If they have a doctor's letter, ask about their condition mentioned in the letter
+        The patient's data is: {json.dumps(user_model_dict, indent=4, ensure_ascii=False)}"""
+        return [{"role": "system", "content": initial_prompt}]
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier part of this conversation: {summary}"})
+    return messages + list(history) + [{"role": "user", "content": message}]
+
+SUMMARY_PROMPT = """Summarize this part of a conversation between a healthcare assistant and a patient in a few sentences, for the assistant to continue the conversation. Keep every question that was asked and what the patient said about their health, feelings and medication. If a summary of the conversation before it is given, include it in your summary."""
+
+# Only the latest turns that fit the budget go into the prompt, older ones as a short summary
+CONVERSATION_TOKEN_BUDGET = int(os.getenv('CONVERSATION_TOKEN_BUDGET', 1500))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_TOKENS', 200))
+CONVERSATION_SUMMARIES = os.getenv('CONVERSATION_SUMMARIES', 'true').lower() in ('1', 'true', 'yes')
+
+def summarize_turns(summary, turns):
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    if summary:
+        transcript = f"Summary so far: {summary}\n\n{transcript}"
+    response = llm_scheduler.call('openai', lambda: client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ],
+        max_tokens=CONVERSATION_SUMMARY_TOKENS
+    ), BACKGROUND)
+    return response.choices[0].message.content
+
+conversations = ConversationStore(
+    maxsize=int(os.getenv('CONVERSATION_MAX_SESSIONS', 1000)),
+    ttl=int(os.getenv('CONVERSATION_TTL', 3600)),
+    max_bytes=int(os.getenv('CONVERSATION_MAX_BYTES', 32 * 1024 * 1024)),
+    token_budget=CONVERSATION_TOKEN_BUDGET,
+    summary_max_chars=CONVERSATION_SUMMARY_TOKENS * 4,
+    summarize=summarize_turns if CONVERSATION_SUMMARIES else None
+)
+
+def conversation_turn(message, user_id):
+    # One conversation per browser session, every 'start' opens a new one. Returns the
+    # conversation key and the messages for the model.
+    if message == 'start' or 'conversation_id' not in session:
+        session['conversation_id'] = uuid.uuid4().hex
+    key = f"{user_id}:{session['conversation_id']}"
+    summary, history = conversations.history(key)
+    return key, chat_messages(message, get_patient_context(user_id), summary, history)
+
+def remember_turn(key, message, reply):
+    conversations.append(key, reply, None if message == 'start' else message)
 
 @voice_chat_bp.route('/chat', methods=['POST'])
 def chat():
@@ -337,57 +412,17 @@ def chat():
         if not user_id:
             return jsonify({'error': 'User not authenticated'}), 401
             
-        # Get user data using model_user_data function
-        user_model_dict = model_user_data(user_id)
-        
-        # Enhanced system prompt for medical data collection
-        system_prompt = f"""You are an empathetic healthcare professional who is supposed to have a short conversation with a patient who potentially already shared some relevant patient data like recent lab results, doctor's letters, their insurance card information and a medication plan. Your goal is to use the context provided in a single dictionary to derive natural language questions that can bring valuable insight into the state and well-being of the patient for a doctor but also not overwhelm the user in their complexity and length. Make sure to use relatively simple language and be empathetic.
-
-        The following schemas detail how the inputs of the user might be structured for each type of input. These inputs are possible:
-        * insuranceCard (Insurance Card Data)
-        * doctorLetter (The most recent Doctor Letter (Arztbrief))
-        * labData (The most recent data gathered from a laboratory analysis)
-        * medicationPlan (A medication plan detailing what medication to take at which times)
-        The Schema are defined as follows
-        insuranceCard:
-        {SCHEMA_INSURANCE_CARD}
-        doctorLetter:
-        {SCHEMA_DOCTOR_LETTER}
-        labData:
-        {SCHEMA_LAB_DATA}
-        medicationPlan:
-        {SCHEMA_MEDICATION_PLAN}
-        You will receive the contextual user data in a dictionary that uses the previously defined inputs as keys (i.e. 'insuranceCard', 'doctorLetter', 'labData', 'medicationPlan') and the corresponding dictionary (defined by the SCHEMA) as the value.
-        Your task is to lead a natural conversation and ask a maximum of 5 questions to find out how the patient feels. Your goal is to find out what the doctors can't describe in their letters and lab analysis - the patients feelings and emotions. 
-        If you notice that the patient wants to end the conversation specifically ask him if he wants to end the conversation. Usually you can assume that they want to continue but if you notice the patient getting aggravated feel free to ask them to stop right there. You can also just end the conversation early by saying these are all the questions I wanted to ask today, thank you for your time. That way the user doesn't even realize that you just purposefully ended the conversation in order to avoid confrontation.
-        For undefined behavior, i.e. queries or answers that have nothing to do with the medical history of the patient and are in general not related to the healthcare of the patient at all are not to be answered. You can just respond with the standard reponse of: "At this time I'm not able to make a comment about this specific topic, let's continue talking about your health".
-        Do not try to match the users style of speaking (i.e. slang, millenial...) as this might irritate them. The following dictonary is the described user context:
-        {json.dumps(user_model_dict, indent=4, ensure_ascii=False)}"""
-        
-        # Special handling for initial message
-        if message == 'start':
-            initial_prompt = f"""Based on the patient's data, start the conversation with a specific question about their health. DO NOT use generic greetings or ask how you can help. Instead, immediately ask about something specific from their medical data. For example:
-            - If they have lab results, ask about how they're feeling regarding those specific results
-            - If they have a medication plan, ask about their experience with the medications
-            - If they have a doctor's letter, ask about their condition mentioned in the letter
-            The patient's data is: {json.dumps(user_model_dict, indent=4, ensure_ascii=False)}"""
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": initial_prompt}
-                ]
-            )
-        else:
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": message}
-                ]
-            )
+        # User data is served from the patient context cache when possible
+        key, messages = conversation_turn(message, user_id)
+
+        response = llm_scheduler.call('openai', lambda: client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages
+        ), INTERACTIVE)
         
-        return jsonify({'response': response.choices[0].message.content})
+        reply = response.choices[0].message.content
+        remember_turn(key, message, reply)
+        return jsonify({'response': reply})
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -402,69 +437,329 @@ def transcribe():
         if not audio_file.filename:
             return jsonify({'error': 'No audio file selected'}), 400
 
-        # Save the audio file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            audio_file.save(temp_file.name)
-            
-            # Transcribe using OpenAI's Whisper API
-            with open(temp_file.name, 'rb') as audio:
-                transcript = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio
-                )
-            
-            # Clean up the temporary file
-            os.unlink(temp_file.name)
-            
-            return jsonify({'text': transcript.text})
+        return jsonify({'text': transcribe_audio(audio_file.read(), audio_file.filename)})
     except Exception as e:
         print(f"Error in transcribe endpoint: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# WAV recordings are trimmed, downmixed and resampled before upload, AUDIO_PREPROCESSING=false
+# sends every recording as received (for comparing the two in /metrics)
+AUDIO_PREPROCESSING = os.getenv('AUDIO_PREPROCESSING', 'true').lower() in ('1', 'true', 'yes')
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS', 4))
+
+transcription_executor = ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS, thread_name_prefix='whisper')
+
+def whisper(data: bytes, filename: str):
+    # Whisper tells the format from the file name, the bytes are sent from memory so a retry needs no temp file
+    return llm_scheduler.call('whisper', lambda: client.audio.transcriptions.create(
+        model="whisper-1",
+        file=(filename, data)
+    ), INTERACTIVE).text
+
+def transcribe_audio(data: bytes, filename: str):
+    start_time = time.perf_counter()
+    parts = prepare_for_transcription(data) if AUDIO_PREPROCESSING else None
+    if parts is None:
+        text = whisper(data, secure_filename(filename) or 'audio.webm')
+        uploaded = len(data)
+    else:
+        # Parts of a long recording are transcribed in parallel and joined in recording order
+        texts = transcription_executor.map(lambda part: whisper(part, 'audio.wav'), parts)
+        text = ' '.join(part_text.strip() for part_text in texts if part_text.strip())
+        uploaded = sum(len(part) for part in parts)
+
+    seconds = time.perf_counter() - start_time
+    transcription_stats.record(parts is not None, len(data), uploaded, len(parts) if parts is not None else 1, seconds)
+    print(f"Transcribed {filename}: {len(data)} -> {uploaded} bytes in {len(parts) if parts is not None else 1} part(s), {seconds:.2f}s")
+    return text
+
+# Voice settings for every synthesized reply
+TTS_VOICE = {
+    'language_code': "en-US",
+    'name': "en-US-Neural2-F",  # Using a natural-sounding female voice
+    'speaking_rate': 0.9,  # Slightly slower for more natural speech
+    'pitch': 0.0  # Natural pitch
+}
+
+# Replies are cached in memory only, phrases that several patients hear (greetings, the
+# closing sentence) are also kept on disk and synthesized once across restarts
+tts_cache = TTSCache(
+    os.getenv('TTS_CACHE_DIR', 'cache/tts'),
+    max_bytes=int(os.getenv('TTS_CACHE_MAX_BYTES', 50 * 1024 * 1024)),
+    memory_entries=int(os.getenv('TTS_MEMORY_CACHE_SIZE', 128)),
+    memory_ttl=int(os.getenv('TTS_MEMORY_CACHE_TTL', 3600)),
+    persist_after=int(os.getenv('TTS_PERSIST_AFTER_USERS', 3))
+)
+
+def speech_cache_key(text):
+    return TTSCache.key(text, TTS_VOICE['name'], TTS_VOICE['speaking_rate'], TTS_VOICE['pitch'])
+
+def synthesize_speech(text, user_id=None):
+    return tts_cache.get_or_synthesize(speech_cache_key(text), lambda: synthesize_uncached(text), user_id)
+
+def synthesize_uncached(text):
+    # Set the text input to be synthesized
+    synthesis_input = texttospeech.SynthesisInput(text=text)
+
+    # Build the voice request
+    voice = texttospeech.VoiceSelectionParams(
+        language_code=TTS_VOICE['language_code'],
+        name=TTS_VOICE['name'],
+        ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
+    )
+
+    # Select the type of audio file
+    audio_config = texttospeech.AudioConfig(
+        audio_encoding=texttospeech.AudioEncoding.MP3,
+        speaking_rate=TTS_VOICE['speaking_rate'],
+        pitch=TTS_VOICE['pitch']
+    )
+
+    # Perform the text-to-speech request
+    response = llm_scheduler.call('tts', lambda: tts_client.synthesize_speech(
+        input=synthesis_input, voice=voice, audio_config=audio_config
+    ), INTERACTIVE)
+    return response.audio_content
+
+def speech_response(audio, key):
+    response = Response(audio, mimetype='audio/mpeg')
+    response.headers['Content-Disposition'] = 'attachment; filename=speech.mp3'
+    response.set_etag(key)
+    return response
+
 @voice_chat_bp.route('/text-to-speech', methods=['POST'])
 def text_to_speech():
+    # The text stays in the body, it is patient conversation and must not end up in URLs and access
+    # logs. The ETag is the cache key, GET /text-to-speech/<key> serves the same clip cacheably.
     try:
         data = request.get_json()
         if not data or 'text' not in data:
             return jsonify({'error': 'No text provided'}), 400
 
-        text = data['text']
-        
-        # Set the text input to be synthesized
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-
-        # Build the voice request
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="en-US",
-            name="en-US-Neural2-F",  # Using a natural-sounding female voice
-            ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
-        )
-
-        # Select the type of audio file
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=0.9,  # Slightly slower for more natural speech
-            pitch=0.0  # Natural pitch
-        )
-
-        # Perform the text-to-speech request
-        response = tts_client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
-
-        # Create a temporary file to store the audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
-            temp_file.write(response.audio_content)
-            temp_file_path = temp_file.name
-
-        # Send the audio file
-        return send_file(
-            temp_file_path,
-            mimetype='audio/mpeg',
-            as_attachment=True,
-            download_name='speech.mp3'
-        )
+        key = speech_cache_key(data['text'])
+        response = speech_response(synthesize_speech(data['text'], session.get('user_id')), key)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
 
     except Exception as e:
         print(f"Error in text-to-speech endpoint: {str(e)}")
-        return jsonify({'error': str(e)}), 500 
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@voice_chat_bp.route('/text-to-speech/<key>', methods=['GET'])
+def cached_speech(key):
+    if not session.get('user_id'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    if not re.fullmatch(r'[0-9a-f]{64}', key):
+        return jsonify({'error': 'Invalid speech key'}), 400
+
+    # The clip for a key never changes, a client that already has it needs nothing
+    if key in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(key)
+    else:
+        audio = tts_cache.get(key)
+        if audio is None:
+            return jsonify({'error': 'Speech not cached, request it with POST /text-to-speech'}), 404
+        response = speech_response(audio, key)
+    response.headers['Cache-Control'] = 'private, max-age=86400, immutable'
+    return response
+
+# A sentence ends at . ! or ? followed by whitespace, so "1.5 mg" stays in one piece
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+# Shorter fragments ("Okay.") are joined with the next sentence instead of getting their own TTS call
+MIN_SENTENCE_CHARS = int(os.getenv('MIN_SENTENCE_CHARS', 12))
+TTS_PIPELINE_WORKERS = int(os.getenv('TTS_PIPELINE_WORKERS', 3))
+
+tts_executor = ThreadPoolExecutor(max_workers=TTS_PIPELINE_WORKERS, thread_name_prefix='tts')
+
+def split_sentences(text):
+    # Returns the complete sentences in text and the unfinished rest
+    parts = SENTENCE_END.split(text)
+    sentences, pending = [], ''
+    for part in parts[:-1]:
+        pending = f"{pending} {part}".strip()
+        if len(pending) >= MIN_SENTENCE_CHARS:
+            sentences.append(pending)
+            pending = ''
+    return sentences, f"{pending} {parts[-1]}" if pending else parts[-1]
+
+def open_reply_stream(messages):
+    # The scheduler slot is held while the reply streams, closing the stream gives it back
+    return llm_scheduler.stream('openai', lambda: client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=messages,
+        stream=True
+    ), INTERACTIVE)
+
+def elapsed(start_time):
+    return round(time.perf_counter() - start_time, 3)
+
+def spoken_reply_events(stream, start_time, timings, label, on_reply=None, user_id=None):
+    # One event per sentence with its text and base64 MP3, in order, then a "done" event with the
+    # full text and the timings (seconds since start_time). Each sentence goes to TTS as soon as
+    # the completion has produced it. on_reply gets the full text once the reply is complete.
+    # user_id decides whether a sentence is common enough to keep on disk (see TTSCache).
+    pending = deque()
+    reply = []
+
+    def sentences():
+        # Yields None between sentences too, so finished audio is flushed on every chunk
+        buffer = ''
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            timings.setdefault('first_token', elapsed(start_time))
+            complete, buffer = split_sentences(buffer + delta)
+            yield from complete or [None]
+        timings['completion'] = elapsed(start_time)
+        if buffer.strip():
+            yield buffer.strip()
+
+    def sentence_event(sentence, future):
+        audio = future.result()
+        timings.setdefault('first_audio', elapsed(start_time))
+        return sse_event({'text': sentence, 'audio': base64.b64encode(audio).decode('ascii')})
+
+    try:
+        for sentence in sentences():
+            if sentence:
+                reply.append(sentence)
+                pending.append((sentence, tts_executor.submit(synthesize_speech, sentence, user_id)))
+            # Send whatever is already synthesized without waiting for the completion to finish
+            while pending and pending[0][1].done():
+                yield sentence_event(*pending.popleft())
+        while pending:
+            yield sentence_event(*pending.popleft())
+        timings['total'] = elapsed(start_time)
+        if on_reply:
+            on_reply(' '.join(reply))
+        yield sse_event({'response': ' '.join(reply), 'timings': timings}, event='done')
+    except Exception as e:
+        print(f"Error while streaming {label}: {str(e)}")
+        yield sse_event({'error': str(e)}, event='error')
+    finally:
+        # Also runs when the client goes away: stop the completion, release its scheduler slot
+        # and drop queued synthesis
+        stream.close()
+        for _, future in pending:
+            future.cancel()
+        timings.setdefault('total', elapsed(start_time))
+        print(f"{label}: {len(reply)} sentence(s), timings {timings}")
+
+@voice_chat_bp.route('/chat/speech', methods=['POST'])
+def chat_speech():
+    # Same body as /chat, the reply comes back as Server-Sent Events (see spoken_reply_events)
+    data = request.get_json()
+    if not data or 'message' not in data:
+        return jsonify({'error': 'No message provided'}), 400
+
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    message = data['message']
+    try:
+        key, messages = conversation_turn(message, user_id)
+        start_time = time.perf_counter()
+        stream = open_reply_stream(messages)
+    except Exception as e:
+        print(f"Error in chat speech endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    return sse_response(spoken_reply_events(
+        stream, start_time, {}, f"Chat speech for {user_id}", lambda reply: remember_turn(key, message, reply), user_id
+    ), on_close=stream.close)
+
+@voice_chat_bp.route('/voice-turn', methods=['POST'])
+def voice_turn():
+    # A whole spoken turn in one round trip: the recording goes in, a "transcript" event comes
+    # back first, then the spoken reply events of /chat/speech. The "done" event carries the
+    # per-stage timings of the turn (transcription, first_token, completion, first_audio, total).
+    if 'file' not in request.files or not request.files['file'].filename:
+        return jsonify({'error': 'No audio file provided'}), 400
+
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    audio_file = request.files['file']
+    start_time = time.perf_counter()
+    try:
+        transcript = transcribe_audio(audio_file.read(), audio_file.filename)
+    except Exception as e:
+        print(f"Error in voice turn endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    return voice_turn_response(transcript, user_id, start_time, f"Voice turn for {user_id}")
+
+def voice_turn_response(transcript, user_id, start_time, label):
+    timings = {'transcription': elapsed(start_time)}
+    if not transcript.strip():
+        return jsonify({'error': 'No speech detected', 'text': '', 'timings': timings}), 422
+
+    try:
+        key, messages = conversation_turn(transcript, user_id)
+        stream = open_reply_stream(messages)
+    except Exception as e:
+        print(f"Error in {label}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    def generate():
+        yield sse_event({'text': transcript, 'timings': dict(timings)}, event='transcript')
+        yield from spoken_reply_events(stream, start_time, timings, label, lambda reply: remember_turn(key, transcript, reply), user_id)
+
+    return sse_response(generate(), on_close=stream.close)
+
+# Recording in chunks: the browser opens a session, posts raw 16 kHz mono PCM16 chunks while the
+# patient speaks and finishes the session when they stop. Segments between pauses are transcribed
+# while recording is still going, finishing only waits for the last one.
+@voice_chat_bp.route('/audio-sessions', methods=['POST'])
+def create_audio_session():
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    audio_session = audio_sessions.create(user_id, transcribe_audio)
+    if not audio_session:
+        # The browser falls back to uploading the whole recording
+        return jsonify({'error': 'Too many open audio sessions, try again later'}), 503
+    return jsonify({'session_id': audio_session.id, 'sample_rate': SAMPLE_RATE, 'encoding': 'pcm_s16le'}), 201
+
+@voice_chat_bp.route('/audio-sessions/<session_id>/chunks', methods=['POST'])
+def append_audio_chunk(session_id):
+    audio_session = audio_sessions.get(session_id, session.get('user_id'))
+    if not audio_session:
+        return jsonify({'error': 'Audio session not found'}), 404
+
+    try:
+        segments = audio_session.append(request.args.get('seq', type=int), request.get_data())
+    except ValueError as e:
+        # Chunks have to arrive in order, the client sends the next one after this answer
+        return jsonify({'error': str(e), 'expected_seq': audio_session.next_seq}), 409
+    except OverflowError as e:
+        return jsonify({'error': str(e)}), 413
+    return jsonify({'received': audio_session.next_seq, 'segments': segments})
+
+@voice_chat_bp.route('/audio-sessions/<session_id>/finish', methods=['POST'])
+def finish_audio_session(session_id):
+    # Answers like /voice-turn, "transcription" in the timings is the wait after recording stopped
+    user_id = session.get('user_id')
+    audio_session = audio_sessions.pop(session_id, user_id)
+    if not audio_session:
+        return jsonify({'error': 'Audio session not found'}), 404
+
+    start_time = time.perf_counter()
+    try:
+        transcript = audio_session.finish()
+    except Exception as e:
+        print(f"Error in audio session endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    return voice_turn_response(transcript, user_id, start_time, f"Audio session turn for {user_id}")
+
+@voice_chat_bp.route('/audio-sessions/<session_id>', methods=['DELETE'])
+def cancel_audio_session(session_id):
+    audio_session = audio_sessions.pop(session_id, session.get('user_id'))
+    if not audio_session:
+        return jsonify({'error': 'Audio session not found'}), 404
+    audio_session.cancel()
+    return '', 204